@@ -0,0 +1,136 @@
+# %%
+#
+#  batch_predict.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-22.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# batched inference of a DefaultPredictor, the next batch is loaded while the model runs
+from concurrent.futures import ThreadPoolExecutor
+import torch
+
+if __name__ == '__main__':
+    from image_io import read_image
+    from image_index import get_image_info
+    from resize_cache import config_sizes, prepare_resized, resized_lookup
+    from pred_store import get_pred_store, entry_to_outputs
+    from class_probs import attach_class_probs
+    from tumor_config import input_option
+else:
+    from src.image_io import read_image
+    from src.image_index import get_image_info
+    from src.resize_cache import config_sizes, prepare_resized, resized_lookup
+    from src.pred_store import get_pred_store, entry_to_outputs
+    from src.class_probs import attach_class_probs
+    from src.tumor_config import input_option
+
+
+class BatchPredictor():
+    """
+    same outputs as predictor(img) per image, but one forward pass of
+    predictor.model per batch. a thread pool decodes and resizes the next
+    batch in the meantime. with a PredStore only images without stored
+    predictions are run, those give the stored top_k instances (masks
+    decoded on access), new predictions are returned in full.
+    the instances carry the class probabilities as pred_probs
+    """
+
+    def __init__(self, predictor, batch_size=8, workers=4, store=None):
+        self.predictor = attach_class_probs(predictor)
+        self.batch_size = max(1, batch_size)
+        self.workers = max(1, workers)
+        self.store = store
+        self.cfg = predictor.cfg
+        # detectron2 renamed transform_gen -> aug
+        self.aug = getattr(predictor, 'aug', None) or predictor.transform_gen
+        self.sizes = config_sizes(self.cfg) if input_option(self.cfg, 'PRE_RESIZE') else None
+
+    def load(self, path, keep_image=False, entry=None):
+        """
+        (original BGR image or None, model input) of the image at path,
+        for a stored entry (image or None, rebuilt outputs)
+        """
+        if entry is not None:
+            return (read_image(path) if keep_image else None), entry_to_outputs(entry)
+
+        file_name, scale = path, None
+        if self.sizes is not None:
+            file_name, scale = resized_lookup(path, self.sizes)
+
+        img = read_image(file_name, img_format=self.predictor.input_format)
+        if scale is None:
+            height, width = img.shape[:2]
+        else:
+            # the model scales its outputs to the original size
+            info = get_image_info(path)
+            height, width = info["height"], info["width"]
+
+        image = self.aug.get_transform(img).apply_image(img)
+        inputs = {
+            "image": torch.as_tensor(image.astype("float32").transpose(2, 0, 1)),
+            "height": height,
+            "width": width,
+        }
+
+        original = None
+        if keep_image:
+            original = img if scale is None and self.predictor.input_format != "RGB" \
+                else read_image(path)
+        return original, inputs
+
+    def predict(self, paths, keep_images=False):
+        """
+        generator of (image, outputs) for all paths in order, image is the
+        BGR image as cv2.imread with keep_images, else None
+        """
+        paths = list(paths)
+        entries = [self.store.get(path) if self.store is not None else None for path in paths]
+
+        misses = [path for path, entry in zip(paths, entries) if entry is None]
+        if self.sizes is not None and misses:
+            prepare_resized(misses, self.cfg)
+
+        batches = [list(range(i, min(i + self.batch_size, len(paths))))
+                   for i in range(0, len(paths), self.batch_size)]
+        with ThreadPoolExecutor(self.workers) as pool:
+            def submit(batch):
+                return [pool.submit(self.load, paths[i], keep_images, entries[i]) for i in batch]
+
+            futures = submit(batches[0]) if batches else []
+            for num, batch in enumerate(batches):
+                loaded = [future.result() for future in futures]
+                # prefetch the next batch while the model runs
+                if num + 1 < len(batches):
+                    futures = submit(batches[num + 1])
+
+                todo = [j for j, i in enumerate(batch) if entries[i] is None]
+                results = [outputs for _, outputs in loaded]
+                if todo:
+                    with torch.no_grad():
+                        outputs = self.predictor.model([loaded[j][1] for j in todo])
+                    for j, output in zip(todo, outputs):
+                        # only the stored entry is cut to top_k
+                        results[j] = output
+                        if self.store is not None:
+                            self.store.add(paths[batch[j]], output)
+
+                for (image, _), output in zip(loaded, results):
+                    yield image, output
+
+        if self.store is not None:
+            self.store.save()
+
+    def __call__(self, paths, keep_images=False):
+        return self.predict(paths, keep_images=keep_images)
+
+
+def predict_files(predictor, paths, batch_size=8, keep_images=False, use_store=True):
+    """
+    generator of (image, outputs) for the paths, see BatchPredictor.
+    use_store reads / writes the predictions of the PredStore
+    """
+    store = get_pred_store(predictor) if use_store else None
+    return BatchPredictor(predictor, batch_size=batch_size, store=store).predict(
+        paths, keep_images=keep_images)
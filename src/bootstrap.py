@@ -0,0 +1,106 @@
+# %%
+#
+#  bootstrap.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-25.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# bootstrap confidence intervals, all resamples are drawn as one index matrix
+import numpy as np
+from scipy.stats import rankdata
+
+N_BOOT = 10000
+ALPHA = 0.05
+
+
+def resample_idx(num, n_boot=N_BOOT, strata=None, seed=0):
+    """
+    (n_boot, num) indices drawn with replacement. with strata every
+    resample keeps the size of each stratum (e.g. the entities)
+    """
+    rng = np.random.default_rng(seed)
+    if strata is None:
+        return rng.integers(0, num, size=(n_boot, num))
+
+    strata = np.asarray(strata)
+    idx = np.empty((n_boot, num), dtype=np.int64)
+    for stratum in np.unique(strata):
+        members = np.flatnonzero(strata == stratum)
+        idx[:, members] = members[rng.integers(0, len(members), size=(n_boot, len(members)))]
+    return idx
+
+
+def interval(values, alpha=ALPHA):
+    """percentile interval (low, high) over the resamples (axis 0)"""
+    low, high = np.nanpercentile(values, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    return low, high
+
+
+def boot_mean(values, idx):
+    """mean of (n,) or (n, k) values, e.g. correct per task, for every resample"""
+    return np.asarray(values, dtype=np.float64)[idx].mean(axis=1)
+
+
+def boot_rates(targets, preds, idx):
+    """
+    accuracy, sensitivity and specificity of every resample. targets are
+    0 / 1, predictions other than 0 / 1 (unclassified) count as wrong
+    """
+    targets = np.asarray(targets)[idx]
+    preds = np.asarray(preds)[idx]
+    positive = targets == 1
+    negative = targets == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sens = np.sum(positive & (preds == 1), axis=1) / np.sum(positive, axis=1)
+        spec = np.sum(negative & (preds == 0), axis=1) / np.sum(negative, axis=1)
+    acc = np.mean(targets == preds, axis=1)
+    return acc, sens, spec
+
+
+def boot_auroc(targets, scores, idx):
+    """
+    AUROC of the 0 / 1 targets and scores of every resample, via rank sums.
+    nan scores (unclassified) are left out
+    """
+    scores = np.asarray(scores, dtype=np.float64)[idx]
+    valid = ~np.isnan(scores)
+    targets = (np.asarray(targets)[idx] == 1) & valid
+    # the left out samples take the lowest ranks, shift them away
+    ranks = rankdata(np.where(valid, scores, -np.inf), axis=1) - np.sum(~valid, axis=1, keepdims=True)
+    n_pos = targets.sum(axis=1)
+    n_neg = valid.sum(axis=1) - n_pos
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (np.sum(ranks * targets, axis=1) - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+
+def conf_to_labels(conf):
+    """(targets, preds) reproducing the confusion matrix (rows: targets, cols: predictions)"""
+    conf = np.asarray(conf, dtype=np.int64)
+    rows, cols = np.indices(conf.shape)
+    return np.repeat(rows.ravel(), conf.ravel()), np.repeat(cols.ravel(), conf.ravel())
+
+
+def conf_rates(conf, n_boot=N_BOOT, seed=0):
+    """
+    sensitivity, specificity and accuracy of a benign / malign confusion
+    matrix, each as (value, count, total, low, high). resampled within the
+    true classes, so both always occur
+    """
+    targets, preds = conf_to_labels(conf)
+    idx = resample_idx(len(targets), n_boot, strata=targets, seed=seed)
+    boot = dict(zip(['accuracy', 'sensitivity', 'specificity'], boot_rates(targets, preds, idx)))
+
+    selects = {
+        'sensitivity': targets == 1,
+        'specificity': targets == 0,
+        'accuracy': np.ones(len(targets), dtype=bool),
+    }
+    res = {}
+    for name, select in selects.items():
+        count = int(np.sum(targets[select] == preds[select]))
+        total = int(np.sum(select))
+        low, high = interval(boot[name])
+        res[name] = (count / total if total else np.nan, count, total, low, high)
+    return res
@@ -6,6 +6,10 @@
 #  Created by Nikolas Wilhelm on 2020-06-10.
 #  Copyright © 2020 Nikolas Wilhelm. All rights reserved.
 #
+import numpy as np
+import pandas as pd
+
+
 def make_cat(simple=True):
     """fill the categories manually"""
     if simple:
@@ -318,4 +322,69 @@ benign_int = [
     5, 6, 7, 8, 9, 10, 12, 13, 14, 15
 ]
 
+
+# array versions of the mappings for vectorized lookups. the extra last row /
+# entry belongs to unknown entities, which get the id -1. the position of a
+# name in ENTITY_INDEX is its entity id
+ENTITY_INDEX = pd.Index(reverse_cat_list, dtype=object)
+UNKNOWN_ID = -1
+
+TASK_MATRIX = np.array(
+    [cat_mapping_new[name] for name in reverse_cat_list] + [[UNKNOWN_ID] * len(cat_naming_new)],
+    dtype=np.int64)
+
+MALIGN_MASK = np.isin(np.arange(len(reverse_cat_list) + 1), malign_int)
+BENIGN_MASK = np.isin(np.arange(len(reverse_cat_list) + 1), benign_int)
+
+
+def entity_ids(names):
+    """entity ids of an array of entity names, unknown names (or nan) -> -1"""
+    return ENTITY_INDEX.get_indexer(pd.Index(names, dtype=object)).astype(np.int64)
+
+
+def checked_ids(ids):
+    """ids as int array, ids outside of the entities -> -1"""
+    ids = np.asarray(ids, dtype=np.int64)
+    return np.where((ids >= 0) & (ids < len(reverse_cat_list)), ids, UNKNOWN_ID)
+
+
+def task_labels(ids, task=None):
+    """
+    labels of all tasks of cat_naming_new for an array of entity ids,
+    shape ids.shape + (tasks,), or of the single task index. unknown ids -> -1
+    """
+    labels = TASK_MATRIX[checked_ids(ids)]
+    return labels if task is None else labels[..., task]
+
+
+def task_probabilities(entity_probs, task):
+    """
+    (n, entities) probabilities -> (n, classes of the task), summed over
+    the entities mapped to each class
+    """
+    labels = TASK_MATRIX[:len(reverse_cat_list), task]
+    onehot = np.zeros((len(labels), cat_naming_new[task]['cat']))
+    onehot[np.arange(len(labels)), labels] = 1
+    return np.asarray(entity_probs, dtype=np.float64) @ onehot
+
+
+# index of the 'malignant' task, the benign / malign ground truth of the scores
+MALIGNANT_TASK = 5
+
+
+def is_malign(ids):
+    """bool array, True for the malignant entities"""
+    return MALIGN_MASK[checked_ids(ids)]
+
+
+def is_benign(ids):
+    """bool array, True for the benign entities"""
+    return BENIGN_MASK[checked_ids(ids)]
+
+
+def same_malignancy(pred_ids, true_ids):
+    """bool array, True if both are malignant or both are benign"""
+    return ((is_malign(pred_ids) & is_malign(true_ids)) |
+            (is_benign(pred_ids) & is_benign(true_ids)))
+
 # %%
@@ -0,0 +1,36 @@
+# %%
+#
+#  class_probs.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-24.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# per-class probabilities of every predicted instance, taken from the box head softmax
+
+
+def attach_class_probs(predictor):
+    """
+    wrap the inference of the box predictor, every predicted instance then
+    carries pred_probs: the softmax over the foreground classes of the
+    proposal it was selected from, normed to 1. wrapping twice is a no-op
+    """
+    box_predictor = predictor.model.roi_heads.box_predictor
+    if getattr(box_predictor, 'with_probs', False):
+        return predictor
+
+    inference = box_predictor.inference
+
+    def inference_with_probs(predictions, proposals):
+        pred_instances, kept_indices = inference(predictions, proposals)
+        probs = box_predictor.predict_probs(predictions, proposals)
+        for instances, prob, kept in zip(pred_instances, probs, kept_indices):
+            # the last column is the background
+            fg_probs = prob[kept, :-1]
+            instances.pred_probs = fg_probs / fg_probs.sum(dim=1, keepdim=True).clamp(min=1e-12)
+        return pred_instances, kept_indices
+
+    box_predictor.inference = inference_with_probs
+    box_predictor.with_probs = True
+    return predictor
@@ -0,0 +1,134 @@
+# %%
+#
+#  cohort_stats.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-12.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# cohort tables of all splits, computed in one groupby pass
+import numpy as np
+import pandas as pd
+
+if __name__ == '__main__':
+    from categories import reverse_cat_list
+else:
+    from src.categories import reverse_cat_list
+
+
+POSITION_GROUPS = {
+    'Torso/head': ['Becken', 'Thoraxwand', 'Huefte', 'LWS', 'os sacrum'],
+    'Upper Extremity': ['Oberarm', 'Hand', 'Schulter', 'Unterarm'],
+    'Lower Extremity': ['Unterschenkel', 'Fuß', 'Knie', 'Oberschenkel'],
+}
+OTHER_POSITION = 'Other'
+ALL_SPLIT = 'All'
+
+
+def calculate_ages(born, diag, date_format="%d.%m.%Y"):
+    """age in years (difference of the calendar years), vectorized"""
+    born = pd.to_datetime(pd.Series(born), format=date_format)
+    diag = pd.to_datetime(pd.Series(diag), format=date_format)
+    return (diag.dt.year - born.dt.year).to_numpy()
+
+
+def cohort_frame(data_fr_loc, dis, ages, t_key='Tumor.Entitaet', pos_key='Befundlokalisation',
+                 class_key='Aggressiv/Nicht-aggressiv', f_key='FileName (png)', mode=False):
+    """one row per case with split, age, sex, malignancy, entity and location group"""
+    if mode:
+        female = (data_fr_loc['Geschlecht'] == 'f').to_numpy()
+    else:
+        female = data_fr_loc[f_key].str[0].eq('F').to_numpy()
+
+    position = pd.Series(OTHER_POSITION, index=data_fr_loc.index)
+    for group, places in POSITION_GROUPS.items():
+        position[data_fr_loc[pos_key].isin(places)] = group
+
+    split = pd.Series(None, index=data_fr_loc.index, dtype=object)
+    for key in dis.keys():
+        split[dis[key]['idx']] = key
+
+    return pd.DataFrame({
+        'split': split.to_numpy(),
+        'age': np.asarray(ages, dtype=float),
+        'female': female.astype(int),
+        'malignant': data_fr_loc[class_key].astype(float).astype(int).to_numpy(),
+        'entity': data_fr_loc[t_key].to_numpy(),
+        'location': position.to_numpy(),
+    }, index=data_fr_loc.index)
+
+
+def cohort_tables(frame, splits):
+    """
+    all tables from the split x entity x location x sex x malignancy cube,
+    the cases of all splits are added as split 'All'
+    """
+    frame = pd.concat([frame, frame.assign(split=ALL_SPLIT)], ignore_index=True)
+    splits = list(splits) + [ALL_SPLIT]
+
+    # the single pass over the cases
+    keys = ['split', 'entity', 'location', 'female', 'malignant']
+    cube = frame.groupby(keys, dropna=False).size()
+
+    ages = frame.groupby('split')['age'].agg(['mean', lambda age: age.std(ddof=0)])
+    ages.columns = ['age_mean', 'age_std']
+
+    def marginal(level, columns):
+        table = cube.groupby(level=['split', level]).sum().unstack(level, fill_value=0)
+        return table.reindex(index=splits, columns=columns, fill_value=0)
+
+    sex = marginal('female', [0, 1]).rename(columns={0: 'male', 1: 'female'})
+    malignancy = marginal('malignant', [0, 1]).rename(columns={0: 'benign', 1: 'malignant'})
+
+    count = sex.sum(axis=1)
+    summary = pd.DataFrame({
+        'n': count,
+        'n_percent': 100 * count / count[ALL_SPLIT],
+        'age_mean': ages['age_mean'].reindex(splits),
+        'age_std': ages['age_std'].reindex(splits),
+        'female': sex['female'],
+        'female_percent': 100 * sex['female'] / count,
+        'malignant': malignancy['malignant'],
+        'malignant_percent': 100 * malignancy['malignant'] / count,
+        'benign': malignancy['benign'],
+        'benign_percent': 100 * malignancy['benign'] / count,
+    })
+
+    tables = {
+        'cube': cube,
+        'summary': summary,
+        'entity': marginal('entity', reverse_cat_list),
+        'location': marginal('location', list(POSITION_GROUPS.keys()) + [OTHER_POSITION]),
+        'sex': sex,
+        'malignancy': malignancy,
+    }
+    return tables
+
+
+def print_split(tables, split, nums=1):
+    """summarize the tables of one split as a print message"""
+    summ = tables['summary'].loc[split]
+    num = int(summ['n'])
+
+    print(f'Age: {round(summ["age_mean"], nums)} ± {round(summ["age_std"], nums)}')
+    print(f'Female: {int(summ["female"])} ({round(summ["female_percent"], nums)}%)')
+    malign_p = round(summ["malignant_percent"], nums)
+    print(f'Malignancy: {int(summ["malignant"])} ({malign_p}%)')
+    print(f'Benign: {int(summ["benign"])} ({100 - malign_p}%)')
+
+    for tumor, num_tums in tables['entity'].loc[split].items():
+        print(f'{tumor}: {num_tums} ({round(100 * num_tums / num, nums)}%)')
+
+    for pos_k in POSITION_GROUPS.keys():
+        num_pos = tables['location'].loc[split, pos_k]
+        print(f'{pos_k}: {num_pos} ({round(100 * num_pos / num, nums)}%)')
+
+    print(f'Dataset Nums: {num} ({round(summ["n_percent"], nums)}%)\n\n')
+
+
+def print_cohort(tables, nums=1):
+    """print all splits, 'All' last"""
+    for split in tables['summary'].index:
+        print(f"{split}:")
+        print_split(tables, split, nums=nums)
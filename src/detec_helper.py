@@ -9,9 +9,6 @@
 import os
 import numpy as np
 from PIL import Image, ImageOps
-import nrrd
-import cv2
-from sklearn.metrics import confusion_matrix
 from tqdm.notebook import tqdm
 import matplotlib.pyplot as plt
 
@@ -28,11 +25,17 @@ from detectron2.config import get_cfg
 from src.utils_tumor import format_seg_names, get_advanced_dis_data_fr, get_data_fr_paths
 from src.utils_detectron import F_KEY, CLASS_KEY, ENTITY_KEY
 import src.utils_detectron as ud
-from src.categories import cat_mapping_new, cat_naming_new, reverse_cat_list
+from src.categories import entity_ids
+from src.task_scores import instance_probabilities, predicted_ids, multi_task_scores
+from src.seg_store import get_seg_crop, get_seg_store
+from src.metrics import box_iou_dice, crop_boxes, crop_iou_dice
+from src.bootstrap import N_BOOT, conf_rates, resample_idx, boot_mean, interval
+from src.batch_predict import predict_files
+from src.tumor_config import add_tumor_config
 
 
 setup_logger()
-cfg = get_cfg()
+cfg = add_tumor_config(get_cfg())
 print(detectron2.__version__)
 
 #  function definitions for training and evaluation
@@ -67,12 +70,10 @@ def get_mask_img(data_fr, data_fr_ex, idx, truelab='blue', external=False):
 
     filename = df_loc[F_KEY][idx]
     filename_seg = format_seg_names(filename)
-    nrrd_file = nrrd.read(f'{segpath_loc}/{filename_seg}.seg.nrrd')
-    nrrd_arr = np.transpose(np.array(nrrd_file[0])[:, :, 0] * 90)
+    seg_crop = get_seg_crop(f'{segpath_loc}/{filename_seg}.seg.nrrd')
+    nrrd_arr = seg_crop.crop * np.uint8(90)
 
-    offset_strings = nrrd_file[1]['Segmentation_ReferenceImageExtentOffset'].split(' ')[
-        :2]
-    offset = [int(off) for off in offset_strings]
+    offset = list(seg_crop.origin)
 
     img = Image.fromarray(nrrd_arr, mode='L').convert('L')
     img_mask = img.copy()
@@ -119,9 +120,8 @@ def update(
     else:
         active_idx = train_idx
 
-    img = cv2.imread(d[active_idx[idx]])
-
-    outputs = call_predictor(predictor, img)
+    # stored predictions if this image was seen before
+    [(img, outputs)] = list(predict_files(predictor, [d[active_idx[idx]]], keep_images=True))
     vis = get_vis(outputs, img, scale, bbox, score, mask)
 
     plt.figure(figsize=(8, 8))
@@ -162,7 +162,7 @@ def plot_thresh_iou(ious):
     plt.ylabel("Accuracy")
 
 
-def generate_all_images(predictor, external=False):
+def generate_all_images(predictor, external=False, batch_size=8):
     """Display the activations"""
     mode = 'test'
     scale = 1
@@ -188,14 +188,15 @@ def generate_all_images(predictor, external=False):
 
         add_str = 'external'
 
-    for idx, _ in tqdm(enumerate(active_idx)):
-        img = cv2.imread(d_loc[active_idx[idx]])
+    # batched predictions, the images are loaded in the background
+    results = predict_files(predictor, [d_loc[i] for i in active_idx],
+                            batch_size=batch_size, keep_images=True)
+
+    for idx, (img, outputs) in tqdm(enumerate(results), total=len(active_idx)):
         im_org = Image.fromarray(img)
         pngname = df_loc[F_KEY][active_idx[idx]]
         im_org.save(f'./res/{add_str}/{pngname}.png')
 
-        outputs = call_predictor(predictor, img)
-
         vis = get_vis(outputs, img, scale, bbox, score, mask)
         plt.figure(figsize=(8, 8))
 
@@ -214,8 +215,10 @@ def generate_all_images(predictor, external=False):
 
         img.save(f'./res/{add_str}/{pngname}_annotated.png')
 
+    get_seg_store('./SEG_external' if external else './SEG').save()
+
 
-def personal_advanced_score(predictor, df, imgpath="./PNG"):
+def personal_advanced_score(predictor, df, imgpath="./PNG", batch_size=8, n_boot=N_BOOT):
     """define the accuracy"""
     # get the dataset distribution
     active_idx = test_idx
@@ -223,187 +226,79 @@ def personal_advanced_score(predictor, df, imgpath="./PNG"):
     # get the actibe files
     files = [os.path.join(imgpath, f"{f}.png") for f in df[F_KEY]]
 
-    res = {}
-
-    for loc_cat in cat_naming_new:
-
-        cat_index = loc_cat['index']
-        cat_name = loc_cat['name']
-        res[cat_name] = {}
-
-        # counters during evaluation
-        count = 0
-
-        # to be filled arrays
-        preds, targets = [], []
-
-        # Go over the whole dataset
-        for idx in tqdm(active_idx):
-
-            # load image
-            img = cv2.imread(files[idx])
-
-            # get predicitions
-            outputs = call_predictor(predictor, img)
-            out = outputs["instances"].to("cpu")
-            pred_entity_int = out[:1].pred_classes[0]
-            pred_entity_str = reverse_cat_list[pred_entity_int]
-
-            # now get the mapped local prediciton
-            loc_pred = cat_mapping_new[pred_entity_str][cat_index]
-            preds.append(loc_pred)
-
-            # get the true output
-            true_entity_str = df[ENTITY_KEY][idx]
-            loc_target = cat_mapping_new[true_entity_str][cat_index]
-            targets.append(loc_target)
-
-            # increase count
-            count += 1 if loc_target == loc_pred else 0
-
-        conf = confusion_matrix(targets, preds)
-        acc = count / len(active_idx)
-        print(f'ACC {cat_name}: {round(acc, 3)}')
-
-        res[cat_name] = {
-            'conf': conf,
-            'acc': acc
-        }
+    # one prediction per image, all tasks are mapped from the entity afterwards
+    entity_probs = []
+    results = predict_files(predictor, [files[idx] for idx in active_idx], batch_size=batch_size)
+    for _, outputs in tqdm(results, total=len(active_idx)):
+        entity_probs.append(instance_probabilities(outputs["instances"].to("cpu")))
+
+    # the best class of the first instance is its predicted class, -1 without detection
+    entity_probs = np.array(entity_probs)
+    pred_ids = predicted_ids(entity_probs)
+    true_ids = entity_ids(df[ENTITY_KEY].to_numpy()[active_idx])
+    res = multi_task_scores(pred_ids, true_ids, entity_probs)
+    print(f'Unclassified (no detection): {int(np.sum(pred_ids < 0))} of {len(pred_ids)}')
+
+    # accuracy intervals of all tasks from the same resamples, stratified by entity
+    correct = np.stack([(task_res['preds'] == task_res['targets']) & (pred_ids >= 0)
+                        for task_res in res.values()], axis=1)
+    lows, highs = interval(boot_mean(correct, resample_idx(len(true_ids), n_boot, strata=true_ids)))
+
+    for (cat_name, task_res), low, high in zip(res.items(), lows, highs):
+        task_res['acc_ci'] = (low, high)
+        print(f'ACC {cat_name}: {round(task_res["acc"], 3)} '
+              f'(95% CI: {round(low, 3)} - {round(high, 3)}), AUROC: {round(task_res["auroc"], 3)}')
 
     return res
 
 
-def make_bool(x_var):
-    """turn an array of ints into array of bool"""
-    if x_var > 0:
-        return True
-    return False
-
-
-vfunc = np.vectorize(make_bool)
-
-
-def make_1(x_var):
-    if x_var:
-        return 1
-    return 0
-
-
-vfunc1 = np.vectorize(make_1)
-
-
-def compare_masks(mask1, mask2):
-    """calculate iou and dice score with mask1 and mask2"""
-    overlap = mask1*mask2  # Logical AND
-    intersection = np.sum(overlap)
-    union = mask1 + mask2  # Logical OR
-
-    iou = overlap.sum()/float(union.sum() - overlap.sum())  # Treats "True" as 1,
-    # sums number of Trues
-    # in overlap and union
-    # and divides
-    dice = np.mean((2. * intersection)/float(union.sum()))
-    return iou, dice
-
-
-def get_bb_from_mask(mask):
-    """take max and min from mask in x and y direction"""
-    mask_bb = mask.copy()
-    shape = mask.shape
-    min_y = shape[0]
-    max_y = 0
-
-    min_x = shape[1]
-    max_x = 0
-
-    for row in range(shape[0]):
-        if True in mask[row, :]:
-            max_y = row
-            if row < min_y:
-                min_y = row
-
-    for column in range(shape[1]):
-        if True in mask[:, column]:
-            max_x = column
-            if column < min_x:
-                min_x = column
-
-    mask_bb[min_y:max_y+1, min_x:max_x+1] = True
-
-    return mask_bb
-
-
-def get_iou_masks(predictor, external=False):
+def get_iou_masks(predictor, external=False, batch_size=8):
     """Display the activations"""
-    mask = True
-    bbox = True
     active_idx = test_idx
     d_loc = d
     add_str = 'normal'
     df_loc = df
-
-    iou_all_mask = []
-    dice_all_mask = []
-
-    iou_all_bb = []
-    dice_all_bb = []
+    segpath_loc = './SEG'
 
     if external:
         active_idx = text_ex_idx['idx']
         d_loc = d_ex
         df_loc = df_ex
+        segpath_loc = './SEG_external'
 
         add_str = 'external_1'
 
-    for idx, _ in tqdm(enumerate(active_idx)):
-        img = cv2.imread(d_loc[active_idx[idx]])
+    pred_crops, true_crops = [], []
+
+    results = predict_files(predictor, [d_loc[i] for i in active_idx],
+                            batch_size=batch_size, keep_images=True)
+
+    for idx, (img, outputs) in tqdm(enumerate(results), total=len(active_idx)):
         im_org = Image.fromarray(img)
         pngname = df_loc[F_KEY][active_idx[idx]]
         im_org.save(f'./res/{add_str}/{pngname}.png')
 
-        outputs = call_predictor(predictor, img)
-        vis = get_vis(outputs, img, 1, bbox, 1, mask)
+        # the predicted mask only inside of its box, empty if nothing was detected
+        _, pred_crop = ud.top_box_crop(outputs["instances"].to("cpu")[:1])
+        pred_crops.append(pred_crop)
 
-        instances = outputs["instances"].to("cpu")[:1]
-        instances.remove("pred_masks") if not mask else None
-        instances.pred_boxes = [[0, 0, 0, 0]
-                                ] if not bbox else instances.pred_boxes
+        # the true label, clipped at the image border
+        filename_seg = format_seg_names(pngname)
+        true_crops.append(get_seg_crop(f'{segpath_loc}/{filename_seg}.seg.nrrd').clip(img.shape))
 
-        mask_pred = instances.pred_masks[0].numpy()
-        mask_pred_bb = get_bb_from_mask(mask_pred)
+    iou_all_mask, dice_all_mask = crop_iou_dice(pred_crops, true_crops)
+    iou_all_bb, dice_all_bb = box_iou_dice(
+        crop_boxes(pred_crops), crop_boxes(true_crops), pairwise=True)
 
-        mask_pred = vfunc1(mask_pred)
-        mask_pred_bb = vfunc1(mask_pred_bb)
-
-        img, offset, im_mask = get_mask_img(
-            df, df_ex, idx=active_idx[idx], truelab='red', external=external)
-
-        back_img = Image.fromarray(vis.get_image()[:, :, ::-1] * 0)
-        back_img.paste(img, offset, im_mask)
-        back_img = np.array(back_img)
-
-        mask_true = vfunc(back_img[:, :, 0])
-        mask_true_bb = get_bb_from_mask(mask_true)
-
-        mask_true = vfunc1(mask_true)
-        mask_true_bb = vfunc1(mask_true_bb)
-
-        iou_loc, dice_loc = compare_masks(mask_pred, mask_true)
-        iou_loc_bb, dice_loc_bb = compare_masks(mask_pred_bb, mask_true_bb)
-
-        iou_all_mask.append(iou_loc)
-        dice_all_mask.append(dice_loc)
-
-        iou_all_bb.append(iou_loc_bb)
-        dice_all_bb.append(dice_loc_bb)
-
-    corr_mask = sum([1 if iou > 0.5 else 0 for iou in iou_all_mask])
-    corr_bb = sum([1 if iou > 0.5 else 0 for iou in iou_all_bb])
+    corr_mask = int(np.sum(iou_all_mask > 0.5))
+    corr_bb = int(np.sum(iou_all_bb > 0.5))
 
     print_iou_res(corr_mask, corr_bb, iou_all_mask, dice_all_mask,
                   iou_all_bb, dice_all_bb, external)
 
-    return iou_all_mask, dice_all_mask, iou_all_bb, dice_all_bb
+    get_seg_store(segpath_loc).save()
+
+    return list(iou_all_mask), list(dice_all_mask), list(iou_all_bb), list(dice_all_bb)
 
 
 def print_iou_res(
@@ -424,8 +319,8 @@ def print_iou_res(
         f'Dice BB: {round(np.mean(dice_all_bb), 2)} +/- {round(np.std(dice_all_bb), 2)}')
 
 
-def get_ci(acc, num=140, const=1.96, digits=3, printit=True):
-    """calculate confidence intervall"""
+def get_ci(acc, num, const=1.96, digits=3, printit=True):
+    """normal approximation of the confidence intervall, see bootstrap for the resampled one"""
     acc = round(acc, digits)
     error = 1 - acc
     ci_low = round(
@@ -437,27 +332,15 @@ def get_ci(acc, num=140, const=1.96, digits=3, printit=True):
     return ci_high, ci_low
 
 
-def print_confinfo(conf):
-    """print all relevant infos for confidence intervalls"""
-    true_p = conf[1, 1]
-    true_n = conf[0, 0]
-    fals_p = conf[0, 1]
-    fals_n = conf[1, 0]
-
-    sens = round(true_p / (true_p + fals_n), 3)
-    sens_high, sens_low = get_ci(sens, num=true_p+fals_n, printit=False)
-    spec = round(true_n / (true_n + fals_p), 3)
-    spec_high, spec_low = get_ci(spec, num=true_n+fals_p, printit=False)
-    acc = round((true_n + true_p) / (true_n + fals_p + true_p + fals_n), 3)
-    acc_high, acc_low = get_ci(
-        acc, num=true_n + fals_p + true_p + fals_n, printit=False)
-
-    print(
-        f'sensitivity: {sens} ({true_p} of { (true_p + fals_n)}), 95% CI: {sens_high}% {sens_low}%')
-    print(
-        f'specificity: {spec} ({true_n} of { (true_n + fals_p)}), 95% CI: {spec_high}% {spec_low}%')
-    print(
-        f'acc : {acc} ({true_n + true_p} of { (true_n + fals_p + true_p + fals_n)}), 95% CI: {acc_high}% {acc_low}%')
+def print_confinfo(conf, n_boot=N_BOOT):
+    """
+    print sensitivity, specificity and accuracy of the benign / malign
+    confusion matrix with bootstrapped 95% confidence intervalls. a third
+    column (not classified) counts as wrong
+    """
+    for name, (value, count, total, low, high) in conf_rates(conf, n_boot).items():
+        print(f'{name}: {round(value, 3)} ({count} of {total}), '
+              f'95% CI: {round(100 * low, 1)}% {round(100 * high, 1)}%')
 
 
 def evaluate(dset, predictor):
@@ -7,11 +7,13 @@
 #  Copyright © 2020 Nikolas Wilhelm. All rights reserved.
 #
 import os
-import pandas as pd
-from categories import cat_mapping_new, reverse_cat_list, malign_int, benign_int
+import numpy as np
+from categories import reverse_cat_list, entity_ids, is_malign, is_benign, same_malignancy
 from sklearn.metrics import confusion_matrix
 from utils_detectron import plot_confusion_matrix
-from detec_helper import get_ci
+from utils_tumor import read_data_fr
+from detec_helper import print_confinfo
+from bootstrap import resample_idx, boot_mean, interval
 
 FILE_EVAL_DOC = './evalDoctors'
 F_XLSX = 'datainfo_external.xlsx'
@@ -51,32 +53,8 @@ def extract_local_info(loc_file):
     return loc_file_id, loc_entity, workflow_loc
 
 
-def print_confinfo(conf):
-    """print all relevant infos for confidence intervalls"""
-    true_p = conf[1, 1]
-    true_n = conf[0, 0]
-    fals_p = conf[0, 1] + conf[0, 2]
-    fals_n = conf[1, 0] + conf[1, 2]
-
-    sens = round(true_p / (true_p + fals_n), 2)
-    sens_high, sens_low = get_ci(sens, num=true_p+fals_n, printit=False)
-    spec = round(true_n / (true_n + fals_p), 2)
-    spec_high, spec_low = get_ci(spec, num=true_n+fals_p, printit=False)
-    acc = round((true_n + true_p) / (true_n +
-                                     fals_p + true_p + fals_n), 3)
-    acc_high, acc_low = get_ci(
-        acc, num=true_n + fals_p + true_p + fals_n, printit=False, digits=3)
-
-    print(
-        f'sensitivity: {sens} ({true_p} of { (true_p + fals_n)}), 95% CI: {sens_high}% {sens_low}%')
-    print(
-        f'specificity: {spec} ({true_n} of { (true_n + fals_p)}), 95% CI: {spec_high}% {spec_low}%')
-    print(
-        f'accuracy: {acc} ({true_n + true_p} of { (true_n + fals_p + true_p + fals_n)}), 95% CI: {acc_high}% {acc_low}%')
-
-
 # %% read the dataframe
-df = pd.read_excel(F_XLSX)
+df = read_data_fr(F_XLSX, mode=True)
 
 # %%
 # get all results of ALex / claudio
@@ -95,59 +73,24 @@ for loc_file_per in files_person:
     workflows.append(workflow)
 
 # %%
-score = 0
-score2 = 0
-score3 = 0
-
-ent_pred = []
-ent_true = []
-
-benmal_pred = []
-benmal_true = []
-
-workflow_pred = []
-workflow_true = []
-
-for true_id, true_entity, true_workflow in zip(df[DF_ID], df[DF_ENT], df[DF_WORKFLOW]):
-    # first match id
-    selected_row = ids.index(true_id)
-    entity = entities[selected_row]
-    workflow = workflows[selected_row]
-
-    if entity == true_entity:
-        score += 1
-    if entity in cat_mapping_new.keys():
-        pred_int = cat_mapping_new[entity][0]
-    else:
-        pred_int = 20
-    true_int = cat_mapping_new[true_entity][0]
-
-    if (pred_int in malign_int) and (true_int in malign_int):
-        score2 += 1
-    if (pred_int in benign_int) and (true_int in benign_int):
-        score2 += 1
-    if workflow == true_workflow:
-        score3 += 1
-
-    ent_pred.append(entity)
-    ent_true.append(true_entity)
-
-    workflow_pred.append(workflow)
-    workflow_true.append(true_workflow)
-
-    pred_benmal = 2
-    if pred_int in benign_int:
-        pred_benmal = 0
+# order the readings like the dataframe
+order = [ids.index(true_id) for true_id in df[DF_ID]]
+ent_pred = [entities[row] for row in order]
+ent_true = list(df[DF_ENT])
+workflow_pred = [workflows[row] for row in order]
+workflow_true = list(df[DF_WORKFLOW])
 
-    if pred_int in malign_int:
-        pred_benmal = 1
+# entities outside of the categories get the id -1
+pred_int = entity_ids(ent_pred)
+true_int = entity_ids(ent_true)
 
-    true_benmal = 0
-    if true_int in malign_int:
-        true_benmal = 1
+score = int(np.sum(np.array(ent_pred) == np.array(ent_true)))
+score2 = int(np.sum(same_malignancy(pred_int, true_int)))
+score3 = int(np.sum(np.array(workflow_pred) == np.array(workflow_true)))
 
-    benmal_pred.append(pred_benmal)
-    benmal_true.append(true_benmal)
+# 2 -> predicted entity cannot be classified
+benmal_pred = np.where(is_malign(pred_int), 1, np.where(is_benign(pred_int), 0, 2))
+benmal_true = is_malign(true_int).astype(int)
 
 
 if len(reverse_cat_list) < 17:
@@ -163,7 +106,15 @@ plot_confusion_matrix(benmal_conf, NEMAL_TITLE)
 
 print_confinfo(benmal_conf)
 
-print(f'Entities: {round(100*score / 111, 3)}%')
-print(f'MalBen: {round(100*score2 / 111, 2)}%')
-print(f'Workflow: {round(100*score3 / 111, 2)}%')
-get_ci(score / 111, num=111, digits=4)
+# bootstrapped intervals of all three scores, stratified by entity
+correct = np.stack([
+    np.array(ent_pred) == np.array(ent_true),
+    same_malignancy(pred_int, true_int),
+    np.array(workflow_pred) == np.array(workflow_true),
+], axis=1)
+lows, highs = interval(boot_mean(correct, resample_idx(len(correct), strata=true_int)))
+
+for name, loc_score, low, high in zip(['Entities', 'MalBen', 'Workflow'],
+                                      [score, score2, score3], lows, highs):
+    print(f'{name}: {round(100*loc_score / len(correct), 2)}%, '
+          f'95% CI: {round(100*low, 1)}% {round(100*high, 1)}%')
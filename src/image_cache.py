@@ -0,0 +1,141 @@
+# %%
+#
+#  image_cache.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-19.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# decoded images as .npy files in shared memory, read zero-copy by all processes
+import os
+import hashlib
+import tempfile
+import numpy as np
+
+if __name__ == '__main__':
+    from image_index import file_signature
+else:
+    from src.image_index import file_signature
+
+
+SHM_DIR = '/dev/shm'
+CACHE_NAME = 'bonetumornet_images'
+DEFAULT_BUDGET = 4 << 30
+# evicting down to this part of the budget leaves room for the next writes
+LOW_WATER = 0.9
+
+
+def get_cache_dir():
+    """shared memory if available, else the temp folder"""
+    base = SHM_DIR if os.path.isdir(SHM_DIR) else tempfile.gettempdir()
+    return os.path.join(base, CACHE_NAME)
+
+
+class ImageCache():
+    """
+    decoded images keyed by path, file signature and decode flags. hits are
+    memory mapped read-only, misses are written atomically. the least
+    recently used files (by mtime, touched on every hit) are removed once
+    the cache grows over budget bytes. the size of the folder is only
+    scanned when the running total (last scan + own writes) crosses budget
+    """
+
+    def __init__(self, budget=DEFAULT_BUDGET, cache_dir=None):
+        self.budget = budget
+        self.cache_dir = cache_dir or get_cache_dir()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.total = None
+
+    def _entry_path(self, path, flags):
+        key = [os.path.abspath(path), file_signature(path), flags]
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f'{digest}.npy')
+
+    def get(self, path, flags, loader):
+        """the cached array, or loader(path, flags) which is then cached"""
+        entry_path = self._entry_path(path, flags)
+        try:
+            img = np.load(entry_path, mmap_mode='r')
+            os.utime(entry_path)
+            return img
+        except (FileNotFoundError, ValueError):
+            # missing, or removed / replaced while reading
+            pass
+
+        img = loader(path, flags)
+        size = self._write(entry_path, img) if img.nbytes <= self.budget else 0
+        if size:
+            if self.total is not None:
+                self.total += size
+            if self.total is None or self.total > self.budget:
+                self.evict()
+        return img
+
+    def _write(self, entry_path, img):
+        """write to a temporary file of this process, then rename. the bytes written, 0 if it failed"""
+        tmp_path = f'{entry_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as file:
+                np.save(file, np.ascontiguousarray(img))
+                size = file.tell()
+            os.replace(tmp_path, entry_path)
+            return size
+        except OSError:
+            # shared memory full -> just skip caching this image
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return 0
+
+    def evict(self):
+        """remove the least recently used entries until the cache fits LOW_WATER * budget"""
+        entries = []
+        for item in os.scandir(self.cache_dir):
+            if not item.name.endswith('.npy'):
+                continue
+            try:
+                stat = item.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, item.path))
+
+        total = sum(size for _, size, _ in entries)
+        if total <= self.budget:
+            self.total = total
+            return
+        for _, size, entry_path in sorted(entries):
+            if total <= LOW_WATER * self.budget:
+                break
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total = total
+
+    def clear(self):
+        """remove all entries"""
+        for item in os.scandir(self.cache_dir):
+            try:
+                os.remove(item.path)
+            except FileNotFoundError:
+                pass
+        self.total = 0
+
+
+_CACHE = {}
+
+
+def enable_image_cache(budget=DEFAULT_BUDGET, cache_dir=None):
+    """opt in: all image_io reads of this process go through the cache"""
+    _CACHE['active'] = ImageCache(budget, cache_dir)
+    return _CACHE['active']
+
+
+def disable_image_cache():
+    _CACHE.pop('active', None)
+
+
+def get_image_cache():
+    """the enabled cache or None"""
+    return _CACHE.get('active')
@@ -0,0 +1,195 @@
+# %%
+#
+#  image_index.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-05.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# persistent index of the image sizes, read from the png header only
+import os
+import json
+import struct
+import numpy as np
+from PIL import Image
+
+
+INDEX_NAME = 'image_index.json'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# increase when the meaning of the entries changes, older entries are read again
+INDEX_VERSION = 2
+
+# png chunks which can carry personal information
+META_CHUNKS = {b'tEXt', b'zTXt', b'iTXt', b'tIME', b'eXIf'}
+
+# (bit depth, color type) of the png header -> PIL mode, as PIL opens them
+PNG_MODES = {
+    (1, 0): '1',
+    (2, 0): 'L',
+    (4, 0): 'L',
+    (8, 0): 'L',
+    (16, 0): 'I;16',
+    (8, 2): 'RGB',
+    (16, 2): 'RGB',
+    (1, 3): 'P',
+    (2, 3): 'P',
+    (4, 3): 'P',
+    (8, 3): 'P',
+    (8, 4): 'LA',
+    (16, 4): 'LA',
+    (8, 6): 'RGBA',
+    (16, 6): 'RGBA',
+}
+
+# PIL mode -> (channels, dtype) of np.array(Image.open(...))
+MODE_ARRAYS = {
+    '1': (1, bool),
+    'L': (1, np.uint8),
+    'P': (1, np.uint8),
+    'I': (1, np.int32),
+    'I;16': (1, np.uint16),
+    'LA': (2, np.uint8),
+    'RGB': (3, np.uint8),
+    'RGBA': (4, np.uint8),
+}
+
+
+def get_index_path():
+    """the index lives next to the datainfo in the repository root"""
+    path = os.getcwd()
+    add = "../" if path[-3:] == "src" else ""
+    return os.path.join(path, f'{add}{INDEX_NAME}')
+
+
+def file_signature(path):
+    """size and modification time, used to detect changed files"""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def read_png_header(path):
+    """get width, height, mode and bit depth from the IHDR chunk"""
+    with open(path, 'rb') as file:
+        head = file.read(29)
+
+    if head[:8] != PNG_SIGNATURE or head[12:16] != b'IHDR':
+        # no png -> PIL only parses the header when opening lazily
+        with Image.open(path) as img:
+            width, height = img.size
+            mode = img.mode
+        bits = 1 if mode == '1' else 8
+        return {"width": width, "height": height, "mode": mode, "bits": bits}
+
+    width, height, bits, color_type = struct.unpack('>IIBB', head[16:26])
+    return {
+        "width": width,
+        "height": height,
+        "mode": PNG_MODES[(bits, color_type)],
+        "bits": bits,
+    }
+
+
+def png_chunk_types(path):
+    """types of all chunks of the png, only the chunk headers are read"""
+    types = []
+    with open(path, 'rb') as file:
+        if file.read(8) != PNG_SIGNATURE:
+            return None
+        while True:
+            head = file.read(8)
+            if len(head) < 8:
+                break
+            length, chunk_type = struct.unpack('>I4s', head)
+            types.append(chunk_type)
+            if chunk_type == b'IEND':
+                break
+            # skip data and crc
+            file.seek(length + 4, os.SEEK_CUR)
+    return types
+
+
+def is_plain_png(path):
+    """png without metadata chunks -> can be copied byte for byte"""
+    types = png_chunk_types(path)
+    return types is not None and not META_CHUNKS.intersection(types)
+
+
+class ImageIndex():
+    """
+    image metadata keyed by path, valid as long as size, mtime and the
+    INDEX_VERSION match
+    """
+
+    def __init__(self, index_path=None):
+        self.index_path = index_path or get_index_path()
+        self.entries = {}
+        self.changed = False
+
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, 'r') as file:
+                self.entries = json.load(file)
+
+    def get(self, path):
+        """return the metadata of the image, read the header on a miss"""
+        key = os.path.abspath(path)
+        signature = file_signature(key)
+
+        entry = self.entries.get(key)
+        if entry is None or entry["signature"] != signature or \
+                entry.get("version") != INDEX_VERSION:
+            entry = read_png_header(key)
+            entry["signature"] = signature
+            entry["version"] = INDEX_VERSION
+            self.entries[key] = entry
+            self.changed = True
+
+        return entry
+
+    def known_entries(self, paths):
+        """{key: entry} of the paths already in the index, e.g. to return them from a worker"""
+        keys = [os.path.abspath(path) for path in paths]
+        return {key: self.entries[key] for key in keys if key in self.entries}
+
+    def merge(self, entries):
+        """take over the entries read by another process"""
+        for key, entry in entries.items():
+            if self.entries.get(key) != entry:
+                self.entries[key] = entry
+                self.changed = True
+
+    def save(self):
+        """write the index, only if new entries were added"""
+        if not self.changed:
+            return
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.entries, file)
+        os.replace(tmp_path, self.index_path)
+        self.changed = False
+
+
+_INDEX = {}
+
+
+def get_image_index(index_path=None):
+    """one shared index per index file and process"""
+    index_path = index_path or get_index_path()
+    if index_path not in _INDEX:
+        _INDEX[index_path] = ImageIndex(index_path)
+    return _INDEX[index_path]
+
+
+def get_image_info(path):
+    """width, height, mode and bit depth of the image without decoding it"""
+    return get_image_index().get(path)
+
+
+def empty_canvas(path):
+    """zero array shaped like np.array(Image.open(path))"""
+    info = get_image_info(path)
+    channels, dtype = MODE_ARRAYS[info["mode"]]
+    shape = (info["height"], info["width"])
+    shape = shape if channels == 1 else shape + (channels,)
+    return np.zeros(shape, dtype=dtype)
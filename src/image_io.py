@@ -0,0 +1,69 @@
+# %%
+#
+#  image_io.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-16.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# decode the radiographs with a single channel, three channels only as a view
+import numpy as np
+import cv2
+
+if __name__ == '__main__':
+    from image_cache import get_image_cache
+    from packed_images import packed_lookup
+else:
+    from src.image_cache import get_image_cache
+    from src.packed_images import packed_lookup
+
+
+def imread(path, flags):
+    """cv2.imread, but raise if the image can not be read"""
+    img = cv2.imread(path, flags)
+    if img is None:
+        raise FileNotFoundError(f'Can not read image: {path}')
+    return img
+
+
+def decode(path, flags=cv2.IMREAD_UNCHANGED, cache=None):
+    """
+    decoded image: a view into the packed folder if it is packed, else
+    through the cache (or the enabled one) if there is one
+    """
+    if flags == cv2.IMREAD_UNCHANGED:
+        img = packed_lookup(path)
+        if img is not None:
+            return img
+
+    cache = cache or get_image_cache()
+    if cache is None:
+        return imread(path, flags)
+    return cache.get(path, flags, imread)
+
+
+def as_bgr(gray):
+    """HxW -> read-only HxWx3 view, the gray values are not copied"""
+    return np.broadcast_to(gray[:, :, np.newaxis], gray.shape + (3,))
+
+
+def read_image(path, gray=False, img_format="BGR", cache=None):
+    """
+    decode the image at path.
+    gray=True: HxWx1 uint8, color images are converted.
+    gray=False: HxWx3 in img_format like cv2.imread / utils.read_image. single
+    channel pngs are decoded once and returned as read-only 3 channel view.
+    cache: ImageCache, default the one of enable_image_cache (if any)
+    """
+    img = decode(path, cache=cache)
+
+    if img.dtype == np.uint8 and img.ndim == 2:
+        return img[:, :, np.newaxis] if gray else as_bgr(img)
+
+    # 16 bit, alpha or color -> let OpenCV convert as usual
+    if gray:
+        return decode(path, cv2.IMREAD_GRAYSCALE, cache)[:, :, np.newaxis]
+    img = img if img.dtype == np.uint8 and img.ndim == 3 and img.shape[2] == 3 else \
+        decode(path, cv2.IMREAD_COLOR, cache)
+    return img[:, :, ::-1] if img_format == "RGB" else img
@@ -7,56 +7,39 @@
 #  Copyright © 2020 Nikolas Wilhelm. All rights reserved.
 #
 import os
-import nrrd
 import numpy as np
-from PIL import Image
 from tqdm import tqdm
-from detec_helper import compare_masks, get_bb_from_mask
+from metrics import crop_boxes, crop_iou_dice, box_iou_dice
+from image_index import get_image_info
+from seg_store import get_seg_store, get_seg_crop
 
 
 p1 = 'SEG'
 p2 = 'Intrareader_seg'
 im_p = 'PNG2'
 
-all_segs = os.listdir(p1)
-comp_segs = os.listdir(p2)
+# only the segmentations, the folders also hold the crop stores
+all_segs = [seg for seg in os.listdir(p1) if seg.endswith('.seg.nrrd')]
+comp_segs = [seg for seg in os.listdir(p2) if seg.endswith('.seg.nrrd')]
 
 
-def get_nrrd_mask(filename, img_path, nrrd_path, fac=15, nrrd_key='Segmentation_ReferenceImageExtentOffset'):
-    # load nrrd image
-    readdata, header = nrrd.read(f'{nrrd_path}/{filename}')
-    nrrd_img = np.transpose(readdata[:, :, 0] * fac)
-
-    # get the offsets
-    offset = header[nrrd_key].split()
-    offset = [int(off) for off in offset]
-    offset = offset[0:2]
-
-    # load true image
-    background = Image.open(f'{img_path}/{filename[:-9]}.png')
-    foreground = Image.fromarray(nrrd_img)
-
-    # generate masked image
-    mask = Image.fromarray(np.array(background) * 0)
-    mask.paste(foreground, offset, foreground)
+def get_nrrd_crop(filename, img_path, nrrd_path, nrrd_key='Segmentation_ReferenceImageExtentOffset'):
+    """the crop of the segmentation, clipped to the size of the image"""
+    seg_crop = get_seg_crop(f'{nrrd_path}/{filename}', nrrd_key)
+    info = get_image_info(f'{img_path}/{filename[:-9]}.png')
+    return seg_crop.clip((info["height"], info["width"]))
 
-    return np.array(mask)[:, :, 0]
 
+def get_nrrd_mask(filename, img_path, nrrd_path, fac=15, nrrd_key='Segmentation_ReferenceImageExtentOffset'):
+    # the segmentation is decoded once and kept as crop in the folder's store
+    seg_crop = get_seg_crop(f'{nrrd_path}/{filename}', nrrd_key)
 
-def make_bool(x_var):
-    if x_var > 0:
-        return True
-    return False
-
+    # the true image is only needed for its size -> read the png header
+    info = get_image_info(f'{img_path}/{filename[:-9]}.png')
 
-def make_1(x_var):
-    if x_var:
-        return 1
-    return 0
+    return seg_crop.to_full((info["height"], info["width"]), fac=fac)
 
 
-vfunc = np.vectorize(make_bool)
-vfunc1 = np.vectorize(make_1)
 comp2_seg = []
 
 # ensure all files exist
@@ -65,32 +48,17 @@ for seg in all_segs:
         comp2_seg.append(seg)
 
 
-ious_bb = []
-dice_scores_bb = []
-
-ious_mask = []
-dice_scores_mask = []
-
-# go trough all segmentations
+# the crops of both readers, clipped to the image
+crops1, crops2 = [], []
 for seg in tqdm(comp2_seg):
-    mask1 = get_nrrd_mask(seg, im_p, p1)
-    mask2 = get_nrrd_mask(seg, im_p, p2)
+    crops1.append(get_nrrd_crop(seg, im_p, p1))
+    crops2.append(get_nrrd_crop(seg, im_p, p2))
 
-    mask1_bb = vfunc1(get_bb_from_mask(mask1))
-    mask2_bb = vfunc1(get_bb_from_mask(mask2))
-
-    mask1 = vfunc1(mask1)
-    mask2 = vfunc1(mask2)
-
-    iou_loc, dice_loc = compare_masks(mask1, mask2)
-    iou_loc_bb, dice_loc_bb = compare_masks(mask1_bb, mask2_bb)
-
-    ious_bb.append(iou_loc_bb)
-    dice_scores_bb.append(dice_loc_bb)
-
-    ious_mask.append(iou_loc)
-    dice_scores_mask.append(dice_loc)
+ious_mask, dice_scores_mask = crop_iou_dice(crops1, crops2)
+ious_bb, dice_scores_bb = box_iou_dice(crop_boxes(crops1), crop_boxes(crops2), pairwise=True)
 
+get_seg_store(p1).save()
+get_seg_store(p2).save()
 
 # %%
 iou_mean, iou_std = np.array(ious_mask).mean().round(
@@ -101,10 +69,10 @@ print(f'IOU MASK: {iou_mean} +/- {iou_std}')
 print(f'DICE MASK: {dice_mean} +/- {dice_std}')
 
 
-iou_mean, iou_std = np.array(ious_mask).mean().round(
-    decimals=2), np.array(ious_mask).std().round(decimals=2)
-dice_mean, dice_std = np.array(dice_scores_mask).mean().round(
-    decimals=2), np.array(dice_scores_mask).std().round(decimals=2)
+iou_mean, iou_std = np.array(ious_bb).mean().round(
+    decimals=2), np.array(ious_bb).std().round(decimals=2)
+dice_mean, dice_std = np.array(dice_scores_bb).mean().round(
+    decimals=2), np.array(dice_scores_bb).std().round(decimals=2)
 print(f'IOU BB: {iou_mean} +/- {iou_std}')
 print(f'DICE BB: {dice_mean} +/- {dice_std}')
 # %%
@@ -0,0 +1,114 @@
+# %%
+#
+#  metrics.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-25.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# IoU and Dice of boxes (xyxy, N x M at once) and of masks (only on their crops)
+import numpy as np
+
+if __name__ == '__main__':
+    from seg_store import SegCrop
+else:
+    from src.seg_store import SegCrop
+
+
+def xywh_to_xyxy(boxes):
+    """[x, y, width, height] -> [x_min, y_min, x_max, y_max]"""
+    boxes = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+    boxes[:, 2:] += boxes[:, :2]
+    return boxes
+
+
+def box_area(boxes):
+    """area of xyxy boxes, 0 for degenerated boxes"""
+    boxes = np.asarray(boxes, dtype=np.float64)
+    return np.prod(np.clip(boxes[..., 2:] - boxes[..., :2], 0, None), axis=-1)
+
+
+def _iou_dice(inter, area_sum):
+    """IoU and Dice from the intersections and the summed areas, 0 for empty pairs"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        iou = np.where(area_sum > inter, inter / (area_sum - inter), 0.0)
+        dice = np.where(area_sum > 0, 2 * inter / area_sum, 0.0)
+    return iou, dice
+
+
+def box_iou_dice(boxes_a, boxes_b, pairwise=False):
+    """
+    IoU and Dice of xyxy boxes, (N, M) matrices of all combinations or
+    (N,) of the pairs boxes_a[i], boxes_b[i] with pairwise
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    if not pairwise:
+        boxes_a, boxes_b = boxes_a[:, None], boxes_b[None]
+
+    top_left = np.maximum(boxes_a[..., :2], boxes_b[..., :2])
+    bottom_right = np.minimum(boxes_a[..., 2:], boxes_b[..., 2:])
+    inter = np.prod(np.clip(bottom_right - top_left, 0, None), axis=-1)
+    return _iou_dice(inter, box_area(boxes_a) + box_area(boxes_b))
+
+
+def empty_crop():
+    """SegCrop without any label, e.g. if nothing was detected"""
+    return SegCrop(np.zeros((1, 1), dtype=np.uint8), (0, 0))
+
+
+def mask_crop(mask, box=None, pad=1):
+    """
+    SegCrop of a full size mask. with a xyxy box (e.g. the predicted box,
+    the pasted mask may exceed it by pad) only that region is cut out,
+    else the tight crop around the mask
+    """
+    height, width = mask.shape[:2]
+    if box is None:
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        if len(rows) == 0:
+            return empty_crop()
+        return SegCrop(mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1], (cols[0], rows[0]))
+
+    x_0 = min(max(int(np.floor(box[0])) - pad, 0), width)
+    y_0 = min(max(int(np.floor(box[1])) - pad, 0), height)
+    x_1 = max(min(int(np.ceil(box[2])) + pad, width), x_0)
+    y_1 = max(min(int(np.ceil(box[3])) + pad, height), y_0)
+    return SegCrop(mask[y_0:y_1, x_0:x_1], (x_0, y_0))
+
+
+def crop_boxes(crops):
+    """(N, 4) tight xyxy pixel boxes of the labels of the crops, zeros if empty"""
+    boxes = np.zeros((len(crops), 4))
+    for i, seg_crop in enumerate(crops):
+        rows = np.flatnonzero(seg_crop.crop.any(axis=1))
+        cols = np.flatnonzero(seg_crop.crop.any(axis=0))
+        if len(rows):
+            x_0, y_0 = seg_crop.origin
+            boxes[i] = [x_0 + cols[0], y_0 + rows[0], x_0 + cols[-1] + 1, y_0 + rows[-1] + 1]
+    return boxes
+
+
+def crop_iou_dice(crops_a, crops_b):
+    """
+    (N,) IoU and Dice of the pairs of SegCrops, the intersection is only
+    counted on the overlap of both crops
+    """
+    inter = np.zeros(len(crops_a))
+    area_sum = np.zeros(len(crops_a))
+    for i, (seg_a, seg_b) in enumerate(zip(crops_a, crops_b)):
+        area_sum[i] = np.count_nonzero(seg_a.crop) + np.count_nonzero(seg_b.crop)
+
+        (ax_0, ay_0), (bx_0, by_0) = seg_a.origin, seg_b.origin
+        left, top = max(ax_0, bx_0), max(ay_0, by_0)
+        right = min(ax_0 + seg_a.crop.shape[1], bx_0 + seg_b.crop.shape[1])
+        bottom = min(ay_0 + seg_a.crop.shape[0], by_0 + seg_b.crop.shape[0])
+        if right <= left or bottom <= top:
+            continue
+
+        part_a = seg_a.crop[top - ay_0:bottom - ay_0, left - ax_0:right - ax_0]
+        part_b = seg_b.crop[top - by_0:bottom - by_0, left - bx_0:right - bx_0]
+        inter[i] = np.count_nonzero(np.logical_and(part_a, part_b))
+    return _iou_dice(inter, area_sum)
@@ -0,0 +1,155 @@
+# %%
+#
+#  packed_images.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-21.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# all decoded images of a folder in one memory mapped file, read without inflating
+import os
+import json
+import numpy as np
+import cv2
+
+if __name__ == '__main__':
+    from image_index import file_signature
+    from parallel import map_ordered
+else:
+    from src.image_index import file_signature
+    from src.parallel import map_ordered
+
+
+PACK_SUFFIX = '_packed'
+PACK_DATA = 'images.bin'
+PACK_INDEX = 'images.json'
+
+
+def get_pack_dir(img_dir):
+    """the packed images live next to the original folder"""
+    return os.path.normpath(os.path.abspath(img_dir)) + PACK_SUFFIX
+
+
+def _decode_job(path):
+    """pool job: pixels as cv2.imread(IMREAD_UNCHANGED), None for non uint8 images"""
+    img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if img is None or img.dtype != np.uint8:
+        return None, file_signature(path)
+    return np.ascontiguousarray(img), file_signature(path)
+
+
+class PackedImages():
+    """
+    reader of a packed folder: images.bin holds the pixels of all images,
+    images.json name -> signature, start and shape. get returns views
+    """
+
+    def __init__(self, img_dir):
+        self.img_dir = os.path.abspath(img_dir)
+        self.pack_dir = get_pack_dir(img_dir)
+        self.data_path = os.path.join(self.pack_dir, PACK_DATA)
+        self.index_path = os.path.join(self.pack_dir, PACK_INDEX)
+        self.index = {}
+        self.data = np.zeros(0, dtype=np.uint8)
+
+        if os.path.isfile(self.index_path) and os.path.isfile(self.data_path):
+            with open(self.index_path, 'r') as file:
+                packed = json.load(file)
+            # index and data are replaced one after the other -> check they belong together
+            if packed["size"] == os.path.getsize(self.data_path) and packed["size"] > 0:
+                self.index = packed["images"]
+                self.data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+
+    def _is_valid(self, name, signature):
+        entry = self.index.get(name)
+        return entry is not None and entry["signature"] == signature
+
+    def _view(self, name):
+        entry = self.index[name]
+        size = int(np.prod(entry["shape"]))
+        return self.data[entry["start"]:entry["start"] + size].reshape(entry["shape"])
+
+    def get(self, path):
+        """read-only view of the decoded image, None if it is not packed or changed"""
+        name = os.path.basename(path)
+        if name not in self.index:
+            return None
+        if os.path.isfile(path) and not self._is_valid(name, file_signature(path)):
+            return None
+        return self._view(name)
+
+    def pack(self, names=None, workers=1):
+        """
+        decode all new or changed images of names (default all pngs of the
+        folder) and rewrite the pack, streaming one image at a time
+        """
+        if names is None:
+            names = sorted(name for name in os.listdir(self.img_dir) if name.endswith('.png'))
+        names = [name for name in names if os.path.isfile(os.path.join(self.img_dir, name))]
+        todo = [name for name in names
+                if not self._is_valid(name, file_signature(os.path.join(self.img_dir, name)))]
+        if not todo and set(names) <= set(self.index):
+            return
+
+        os.makedirs(self.pack_dir, exist_ok=True)
+        tmp_data, tmp_index = f'{self.data_path}.tmp', f'{self.index_path}.tmp'
+        index, start = {}, 0
+        with open(tmp_data, 'wb') as file:
+            # keep the valid images of the old pack
+            for name, entry in self.index.items():
+                if name in todo or not os.path.isfile(os.path.join(self.img_dir, name)):
+                    continue
+                view = self._view(name)
+                file.write(view.tobytes())
+                index[name] = dict(entry, start=start)
+                start += view.size
+
+            paths = [os.path.join(self.img_dir, name) for name in todo]
+            for name, (img, signature) in zip(todo, map_ordered(_decode_job, paths, workers=workers)):
+                if img is None:
+                    continue
+                file.write(img.tobytes())
+                index[name] = {"signature": signature, "start": start, "shape": list(img.shape)}
+                start += img.size
+
+        with open(tmp_index, 'w') as file:
+            json.dump({"size": start, "images": index}, file)
+
+        # drop the old mapping before replacing the file
+        self.data = np.zeros(0, dtype=np.uint8)
+        os.replace(tmp_data, self.data_path)
+        os.replace(tmp_index, self.index_path)
+        self.index = index
+        self.data = np.memmap(self.data_path, dtype=np.uint8, mode='r') if start else self.data
+
+        print(f'Packed {len(todo)} new images, {len(index)} in {self.pack_dir}')
+
+
+_PACKS = {}
+
+
+def get_packed_images(img_dir):
+    """one shared reader per image folder and process"""
+    img_dir = os.path.abspath(img_dir)
+    if img_dir not in _PACKS:
+        _PACKS[img_dir] = PackedImages(img_dir)
+    return _PACKS[img_dir]
+
+
+def pack_images(img_dir, names=None, workers=1):
+    """converter: pack the images of the folder (all pngs if names is None)"""
+    packed = get_packed_images(img_dir)
+    packed.pack(names, workers=workers)
+    return packed
+
+
+def packed_lookup(path):
+    """packed pixels of the image at path, None if its folder is not packed"""
+    return get_packed_images(os.path.dirname(path) or '.').get(path)
+
+
+if __name__ == '__main__':
+    for folder in ['../PNG', '../PNG2', '../PNG_external']:
+        if os.path.isdir(folder):
+            pack_images(folder, workers=os.cpu_count())
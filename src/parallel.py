@@ -0,0 +1,27 @@
+# %%
+#
+#  parallel.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-06.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# process pool helpers for the dataset preparation
+from concurrent.futures import ProcessPoolExecutor
+
+
+def map_ordered(func, items, workers=1, chunksize=None):
+    """
+    apply func to all items, optionally sharded over a process pool.
+    the results are yielded in the order of the items
+    """
+    if workers is None or workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    # a few chunks per worker keeps the pool busy without much overhead
+    chunksize = chunksize or max(1, len(items) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(func, items, chunksize=chunksize)
@@ -0,0 +1,77 @@
+# %%
+#
+#  polygons.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-14.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# contours of the segmentation crops for the coco annotations
+import numpy as np
+import cv2
+
+
+def crop_polygons(seg_crop, tolerance=0.0):
+    """
+    contours of the crop in image coordinates, [[x1, y1, x2, y2, ...], ...].
+    with tolerance 0 the same as imantics Mask(full_mask).polygons().segmentation,
+    tolerance > 0 simplifies each contour (Douglas-Peucker, max. deviation in pixels)
+    """
+    x_0, y_0 = seg_crop.origin
+    mask = cv2.copyMakeBorder((seg_crop.crop > 0).astype(np.uint8), 1, 1, 1, 1,
+                              cv2.BORDER_CONSTANT, value=0)
+    contours = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE,
+                                offset=(x_0 - 1, y_0 - 1))
+    contours = contours[0] if len(contours) == 2 else contours[1]
+
+    if tolerance > 0:
+        contours = [cv2.approxPolyDP(contour, tolerance, True) for contour in contours]
+
+    return [contour.flatten().tolist() for contour in contours]
+
+
+def polygon_iou(segm, seg_crop):
+    """IoU between the filled polygons and the raster crop, on their common bbox"""
+    x_0, y_0 = seg_crop.origin
+    c_h, c_w = seg_crop.crop.shape
+    points = [np.asarray(poly, dtype=np.int32).reshape(-1, 2) for poly in segm]
+
+    left, top = x_0, y_0
+    right, bottom = x_0 + c_w, y_0 + c_h
+    for pts in points:
+        left, top = min(left, pts[:, 0].min()), min(top, pts[:, 1].min())
+        right, bottom = max(right, pts[:, 0].max() + 1), max(bottom, pts[:, 1].max() + 1)
+
+    filled = np.zeros((bottom - top, right - left), dtype=np.uint8)
+    cv2.fillPoly(filled, [pts - [left, top] for pts in points], 1)
+
+    raster = np.zeros_like(filled)
+    raster[y_0 - top:y_0 - top + c_h, x_0 - left:x_0 - left + c_w] = seg_crop.crop > 0
+
+    inter = np.count_nonzero(filled & raster)
+    union = np.count_nonzero(filled | raster)
+    return inter / union if union else 1.0
+
+
+def tolerance_report(seg_crops, tolerances=(0.0, 0.5, 1.0, 2.0, 4.0), select=None):
+    """
+    vertices and IoU against the raster mask per tolerance, to pick one
+    that keeps the accuracy. select reduces the polygons of a crop as
+    stored in the annotation (e.g. check_seg)
+    """
+    report = []
+    for tolerance in tolerances:
+        vertices, ious = [], []
+        for seg_crop in seg_crops:
+            segm = crop_polygons(seg_crop, tolerance)
+            segm = select(segm) if select is not None else segm
+            vertices.append(sum(len(poly) // 2 for poly in segm))
+            ious.append(polygon_iou(segm, seg_crop))
+        report.append({
+            'tolerance': tolerance,
+            'vertices_mean': float(np.mean(vertices)),
+            'iou_mean': float(np.mean(ious)),
+            'iou_min': float(np.min(ious)),
+        })
+    return report
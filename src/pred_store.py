@@ -0,0 +1,250 @@
+# %%
+#
+#  pred_store.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-23.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# predictions on disk, keyed by the model weights, the test config and the image content
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+from detectron2.structures import Instances, Boxes
+
+if __name__ == '__main__':
+    from image_index import file_signature
+    from prep_manifest import file_digest
+    import rle
+else:
+    from src.image_index import file_signature
+    from src.prep_manifest import file_digest
+    from src import rle
+
+
+# increase when the stored format or the meaning of the entries changes
+STORE_VERSION = 2
+STORE_NAME = 'pred_store'
+DIGEST_NAME = 'images.json'
+
+# instances kept per image (boxes, classes, scores, class probabilities and masks)
+TOP_K = 10
+
+# config fields changing the predictions
+CFG_FIELDS = [
+    'MODEL.META_ARCHITECTURE',
+    'MODEL.PIXEL_MEAN',
+    'MODEL.PIXEL_STD',
+    'MODEL.ROI_HEADS.NUM_CLASSES',
+    'MODEL.ROI_HEADS.SCORE_THRESH_TEST',
+    'MODEL.ROI_HEADS.NMS_THRESH_TEST',
+    'TEST.DETECTIONS_PER_IMAGE',
+    'INPUT.MIN_SIZE_TEST',
+    'INPUT.MAX_SIZE_TEST',
+    'INPUT.FORMAT',
+    'INPUT.PRE_RESIZE',
+]
+
+
+def get_store_path():
+    """the store lives in the repository root"""
+    path = os.getcwd()
+    add = "../" if path[-3:] == "src" else ""
+    return os.path.join(path, f'{add}{STORE_NAME}')
+
+
+def cfg_value(cfg, field):
+    """value of the dotted config field, None if it does not exist"""
+    node = cfg
+    for part in field.split('.'):
+        node = node.get(part) if hasattr(node, 'get') else None
+        if node is None:
+            return None
+    return list(node) if isinstance(node, (list, tuple)) else node
+
+
+def weights_digest(predictor):
+    """sha1 of the weights file, of the loaded parameters if there is no file"""
+    weights = predictor.cfg.MODEL.WEIGHTS
+    if os.path.isfile(weights):
+        return file_digest(weights)
+    sha = hashlib.sha1()
+    for name, tensor in predictor.model.state_dict().items():
+        sha.update(name.encode('utf-8'))
+        sha.update(tensor.detach().cpu().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def mask_to_rle(mask):
+    """compressed rle of the full size mask, encoded on its bounding box only"""
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        return rle.encode(np.zeros((1, 1), dtype=np.uint8), size=mask.shape, compressed=True)
+    crop = mask[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    return rle.encode(crop, offset=(cols[0], rows[0]), size=mask.shape, compressed=True)
+
+
+def outputs_to_entry(outputs, top_k=TOP_K):
+    """the first top_k instances of the predictor outputs as json entry"""
+    instances = outputs["instances"].to("cpu")[:top_k]
+    entry = {
+        "height": instances.image_size[0],
+        "width": instances.image_size[1],
+        "boxes": instances.pred_boxes.tensor.numpy().tolist(),
+        "classes": instances.pred_classes.numpy().tolist(),
+        "scores": instances.scores.numpy().tolist(),
+    }
+    if instances.has("pred_probs"):
+        entry["probs"] = instances.pred_probs.numpy().tolist()
+    if instances.has("pred_masks"):
+        entry["masks"] = [mask_to_rle(mask) for mask in instances.pred_masks.numpy()]
+    return entry
+
+
+class LazyMasks():
+    """
+    the rle masks of an entry as the pred_masks field of Instances: slicing
+    (as Instances does) only selects, a mask is decoded to full size when it
+    is indexed by an integer or the masks are read as array
+    """
+
+    def __init__(self, rles, height, width):
+        self.rles = list(rles)
+        self.height, self.width = height, width
+
+    def __len__(self):
+        return len(self.rles)
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return torch.from_numpy(rle.decode(self.rles[item]) > 0)
+        if torch.is_tensor(item):
+            item = item.cpu().numpy()
+        idx = np.atleast_1d(np.arange(len(self.rles))[item])
+        return LazyMasks([self.rles[i] for i in idx], self.height, self.width)
+
+    def to(self, *args, **kwargs):
+        """the masks stay on the cpu"""
+        return self
+
+    def numpy(self):
+        masks = np.zeros((len(self.rles), self.height, self.width), dtype=bool)
+        for i, mask_rle in enumerate(self.rles):
+            masks[i] = rle.decode(mask_rle) > 0
+        return masks
+
+    def __array__(self, dtype=None):
+        masks = self.numpy()
+        return masks if dtype is None else masks.astype(dtype)
+
+
+def entry_to_outputs(entry):
+    """predictor outputs {"instances": Instances} rebuilt from the entry"""
+    height, width = entry["height"], entry["width"]
+    instances = Instances((height, width))
+    instances.pred_boxes = Boxes(torch.tensor(entry["boxes"], dtype=torch.float32).reshape(-1, 4))
+    instances.scores = torch.tensor(entry["scores"], dtype=torch.float32)
+    instances.pred_classes = torch.tensor(entry["classes"], dtype=torch.int64)
+    if "probs" in entry:
+        num = len(entry["probs"][0]) if entry["probs"] else 0
+        instances.pred_probs = torch.tensor(
+            entry["probs"], dtype=torch.float32).reshape(len(entry["scores"]), num)
+    if "masks" in entry:
+        # decoded on access, the consumers mostly read the first instance only
+        instances.pred_masks = LazyMasks(entry["masks"], height, width)
+    return {"instances": instances}
+
+
+class PredStore():
+    """
+    one json per image in <root>/<model key>/<image sha1>.json. the model
+    key hashes the weights, the CFG_FIELDS and the STORE_VERSION
+    """
+
+    def __init__(self, predictor, root=None, top_k=TOP_K):
+        self.root = root or get_store_path()
+        self.top_k = top_k
+        os.makedirs(self.root, exist_ok=True)
+
+        # image digests, only computed again if the file signature changed
+        self.digest_path = os.path.join(self.root, DIGEST_NAME)
+        self.digests = {}
+        self.changed = False
+        if os.path.isfile(self.digest_path):
+            with open(self.digest_path, 'r') as file:
+                self.digests = json.load(file)
+
+        meta = {
+            "version": STORE_VERSION,
+            "weights": weights_digest(predictor),
+            "top_k": top_k,
+            "cfg": {field: cfg_value(predictor.cfg, field) for field in CFG_FIELDS},
+        }
+        self.key = hashlib.sha1(json.dumps(meta, sort_keys=True).encode('utf-8')).hexdigest()
+        self.model_dir = os.path.join(self.root, self.key)
+        os.makedirs(self.model_dir, exist_ok=True)
+        with open(os.path.join(self.model_dir, 'meta.json'), 'w') as file:
+            json.dump(meta, file, indent=2)
+
+    def image_digest(self, path):
+        """sha1 of the image content"""
+        key = os.path.abspath(path)
+        signature = file_signature(key)
+        old = self.digests.get(key)
+        if old is not None and old[0] == signature:
+            return old[1]
+        digest = file_digest(key)
+        self.digests[key] = [signature, digest]
+        self.changed = True
+        return digest
+
+    def _entry_path(self, path):
+        return os.path.join(self.model_dir, f'{self.image_digest(path)}.json')
+
+    def get(self, path):
+        """stored entry of the image, None on a miss"""
+        entry_path = self._entry_path(path)
+        if not os.path.isfile(entry_path):
+            return None
+        try:
+            with open(entry_path, 'r') as file:
+                return json.load(file)
+        except ValueError:
+            return None
+
+    def add(self, path, outputs):
+        """store the outputs of the image, return the entry"""
+        entry = outputs_to_entry(outputs, self.top_k)
+        entry_path = self._entry_path(path)
+        tmp_path = f'{entry_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(entry, file)
+        os.replace(tmp_path, entry_path)
+        return entry
+
+    def save(self):
+        """write the image digests, only if new ones were computed"""
+        if not self.changed:
+            return
+        tmp_path = f'{self.digest_path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.digests, file)
+        os.replace(tmp_path, self.digest_path)
+        self.changed = False
+
+
+def get_pred_store(predictor, root=None):
+    """
+    one store per predictor and root, the weights are hashed once. the
+    stores live on the predictor, so they are freed with it and a new
+    predictor never picks up the store of an old one
+    """
+    if not hasattr(predictor, '_pred_store'):
+        predictor._pred_store = {}
+    if root not in predictor._pred_store:
+        predictor._pred_store[root] = PredStore(predictor, root)
+    return predictor._pred_store[root]
@@ -0,0 +1,109 @@
+# %%
+#
+#  prep_manifest.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-09.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# manifest of content hashes per case -> only changed cases are prepared again
+import os
+import json
+import hashlib
+
+if __name__ == '__main__':
+    from image_index import file_signature
+else:
+    from src.image_index import file_signature
+
+
+MANIFEST_NAME = 'prep_manifest.jsonl'
+HASH_KEYS = ['row', 'png', 'seg']
+
+
+def get_manifest_path():
+    """the manifest lives next to the datainfo in the repository root"""
+    path = os.getcwd()
+    add = "../" if path[-3:] == "src" else ""
+    return os.path.join(path, f'{add}{MANIFEST_NAME}')
+
+
+def file_digest(path, blocksize=1 << 20):
+    """sha1 of the file content"""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def row_digest(row):
+    """sha1 of the datainfo values of a case"""
+    text = json.dumps([str(val) for val in row])
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class PrepManifest():
+    """
+    cached image / annotation geometry per case, valid as long as the row,
+    the png and the segmentation hash the same. every new entry is appended
+    as one line, so an interrupted run resumes where it stopped
+    """
+
+    def __init__(self, path=None):
+        self.path = path or get_manifest_path()
+        self.entries = {}
+
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the last line of an interrupted run
+                        continue
+                    self.entries[record["key"]] = record
+
+    def _file_hash(self, path, old):
+        """[signature, digest], the file is only hashed again if its signature changed"""
+        if not os.path.isfile(path):
+            return [None, None]
+        signature = file_signature(path)
+        if old is not None and old[0] == signature:
+            return old
+        return [signature, file_digest(path)]
+
+    def hashes(self, png_path, seg_path, row):
+        """content hashes of a case"""
+        old = self.entries.get(os.path.abspath(png_path), {})
+        return {
+            "row": row_digest(row),
+            "png": self._file_hash(png_path, old.get("png")),
+            "seg": self._file_hash(seg_path, old.get("seg")),
+        }
+
+    def lookup(self, png_path, hashes):
+        """the cached entry if nothing changed, else None"""
+        record = self.entries.get(os.path.abspath(png_path))
+        if record is None or record["row"] != hashes["row"]:
+            return None
+        for key in HASH_KEYS[1:]:
+            if record[key][1] is None or record[key][1] != hashes[key][1]:
+                return None
+        return record["entry"]
+
+    def add(self, png_path, hashes, entry):
+        """keep the new entry and append it to the manifest right away"""
+        record = dict(key=os.path.abspath(png_path), entry=entry, **hashes)
+        self.entries[record["key"]] = record
+        with open(self.path, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+
+    def compact(self):
+        """rewrite the manifest with one line per case"""
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as file:
+            for record in self.entries.values():
+                file.write(json.dumps(record) + '\n')
+        os.replace(tmp_path, self.path)
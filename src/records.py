@@ -0,0 +1,126 @@
+# %%
+#
+#  records.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-18.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# dataset dicts as flat numpy arrays, shared by all dataloader workers
+import numpy as np
+from detectron2.structures import BoxMode
+
+
+IMAGE_KEYS = ['file_name', 'height', 'width', 'image_id', 'annotations', 'sem_seg_file_name']
+PROPOSAL_KEYS = ['proposal_boxes', 'proposal_objectness_logits', 'proposal_bbox_mode']
+ANN_KEYS = ['bbox', 'bbox_mode', 'category_id', 'iscrowd', 'segmentation', 'area']
+
+
+def check_keys(record, known, kind):
+    """only the fields stored by CompactRecords are allowed"""
+    unknown = set(record) - set(known)
+    if unknown:
+        raise ValueError(f'CompactRecords can not store the {kind} fields {unknown}')
+
+
+class CompactRecords():
+    """
+    the detectron2 dataset dicts as a few numpy arrays: one entry per image
+    for the scalars, per annotation for box / class and all polygon
+    coordinates in one flat array with offsets. indexing builds a fresh
+    dict, so no deepcopy is needed and the workers never touch python
+    objects of the whole dataset
+    """
+
+    def __init__(self, dataset_dicts):
+        anns = []
+        for record in dataset_dicts:
+            check_keys(record, IMAGE_KEYS + PROPOSAL_KEYS, 'image')
+            for ann in record.get('annotations', []):
+                check_keys(ann, ANN_KEYS, 'annotation')
+                if not isinstance(ann.get('segmentation', []), list):
+                    raise ValueError('CompactRecords only stores polygon segmentations')
+            anns.extend(record.get('annotations', []))
+
+        # per image
+        self.file_name = np.array([record['file_name'] for record in dataset_dicts])
+        self.height = np.array([record['height'] for record in dataset_dicts], dtype=np.int64)
+        self.width = np.array([record['width'] for record in dataset_dicts], dtype=np.int64)
+        self.image_id = np.array([record['image_id'] for record in dataset_dicts])
+        self.sem_seg_file_name = None
+        if any('sem_seg_file_name' in record for record in dataset_dicts):
+            self.sem_seg_file_name = np.array(
+                [record.get('sem_seg_file_name', '') for record in dataset_dicts])
+        self.has_anns = np.array(['annotations' in record for record in dataset_dicts])
+        self.ann_offsets = np.cumsum(
+            [0] + [len(record.get('annotations', [])) for record in dataset_dicts])
+
+        # per annotation
+        self.bbox = np.array([ann['bbox'] for ann in anns], dtype=np.float64).reshape(-1, 4)
+        self.bbox_mode = np.array([int(ann.get('bbox_mode', BoxMode.XYWH_ABS)) for ann in anns],
+                                  dtype=np.int64)
+        self.category_id = np.array([ann.get('category_id', 0) for ann in anns], dtype=np.int64)
+        self.iscrowd = np.array([ann.get('iscrowd', 0) for ann in anns], dtype=np.int64)
+        self.area = None
+        if any('area' in ann for ann in anns):
+            self.area = np.array([ann.get('area', 0) for ann in anns], dtype=np.float64)
+        self.has_segm = np.array(['segmentation' in ann for ann in anns], dtype=bool)
+
+        # polygons: annotation -> polygon range, polygon -> coordinate range
+        polys = [poly for ann in anns for poly in ann.get('segmentation', [])]
+        self.poly_offsets = np.cumsum([0] + [len(ann.get('segmentation', [])) for ann in anns])
+        self.coord_offsets = np.cumsum([0] + [len(poly) for poly in polys])
+        self.coords = np.concatenate(
+            [np.asarray(poly, dtype=np.float64) for poly in polys]) if polys else np.zeros(0)
+
+        # precomputed proposals (MODEL.LOAD_PROPOSALS): all boxes in one array with offsets
+        self.proposal_offsets = None
+        if any('proposal_boxes' in record for record in dataset_dicts):
+            boxes = [np.asarray(record['proposal_boxes'], dtype=np.float32).reshape(-1, 4)
+                     for record in dataset_dicts]
+            self.proposal_offsets = np.cumsum([0] + [len(box) for box in boxes])
+            self.proposal_boxes = np.concatenate(boxes)
+            self.proposal_logits = np.concatenate(
+                [np.asarray(record['proposal_objectness_logits'], dtype=np.float32).reshape(-1)
+                 for record in dataset_dicts])
+            self.proposal_bbox_mode = np.array(
+                [int(record['proposal_bbox_mode']) for record in dataset_dicts], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.file_name)
+
+    def _annotation(self, idx):
+        """new dict of annotation idx, the polygons are copies of the flat slices"""
+        ann = {
+            'bbox': self.bbox[idx].tolist(),
+            'bbox_mode': BoxMode(int(self.bbox_mode[idx])),
+            'category_id': int(self.category_id[idx]),
+            'iscrowd': int(self.iscrowd[idx]),
+        }
+        if self.area is not None:
+            ann['area'] = float(self.area[idx])
+        if self.has_segm[idx]:
+            starts = self.coord_offsets[self.poly_offsets[idx]:self.poly_offsets[idx + 1] + 1]
+            ann['segmentation'] = [self.coords[start:end].copy()
+                                   for start, end in zip(starts[:-1], starts[1:])]
+        return ann
+
+    def __getitem__(self, idx):
+        record = {
+            'file_name': str(self.file_name[idx]),
+            'height': int(self.height[idx]),
+            'width': int(self.width[idx]),
+            'image_id': self.image_id[idx].item(),
+        }
+        if self.sem_seg_file_name is not None and self.sem_seg_file_name[idx]:
+            record['sem_seg_file_name'] = str(self.sem_seg_file_name[idx])
+        if self.proposal_offsets is not None:
+            start, end = self.proposal_offsets[idx], self.proposal_offsets[idx + 1]
+            record['proposal_boxes'] = self.proposal_boxes[start:end].copy()
+            record['proposal_objectness_logits'] = self.proposal_logits[start:end].copy()
+            record['proposal_bbox_mode'] = BoxMode(int(self.proposal_bbox_mode[idx]))
+        if self.has_anns[idx]:
+            record['annotations'] = [self._annotation(ann_idx) for ann_idx in
+                                     range(self.ann_offsets[idx], self.ann_offsets[idx + 1])]
+        return record
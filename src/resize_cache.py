@@ -0,0 +1,192 @@
+# %%
+#
+#  resize_cache.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-20.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# images stored at the largest size the config can request, next to the originals
+import os
+import json
+import shutil
+import numpy as np
+import cv2
+
+if __name__ == '__main__':
+    from image_index import file_signature, get_image_info
+    from parallel import map_ordered
+else:
+    from src.image_index import file_signature, get_image_info
+    from src.parallel import map_ordered
+
+
+RESIZE_META = 'meta.json'
+RESIZE_SUFFIX = '_resized'
+
+# smallest relative crop height of the training augmentation, assumed for
+# the width as well so the pre-resized image is never too small
+CROP_MIN = 0.7
+
+
+def config_sizes(cfg):
+    """largest short edge and long edge limit of training and test, plus the crop"""
+    def largest(sizes):
+        return int(np.max(np.atleast_1d(sizes)))
+    return {
+        "train": [largest(cfg.INPUT.MIN_SIZE_TRAIN), int(cfg.INPUT.MAX_SIZE_TRAIN)],
+        "test": [largest(cfg.INPUT.MIN_SIZE_TEST), int(cfg.INPUT.MAX_SIZE_TEST)],
+        "crop": [CROP_MIN, CROP_MIN],
+    }
+
+
+def resize_scale(height, width, sizes):
+    """
+    largest scale ResizeShortestEdge can apply to the image (or its
+    smallest training crop), never above 1
+    """
+    scales = []
+    for key, (crop_h, crop_w) in [("train", sizes["crop"]), ("test", (1.0, 1.0))]:
+        short, long_max = sizes[key]
+        if short == 0:
+            # no resizing in this mode
+            return 1.0
+        c_h, c_w = height * crop_h, width * crop_w
+        scales.append(min(short / min(c_h, c_w), long_max / max(c_h, c_w)))
+    return min(1.0, max(scales))
+
+
+def get_resize_dir(img_dir):
+    """the pre-resized images live next to the original folder"""
+    return os.path.normpath(img_dir) + RESIZE_SUFFIX
+
+
+def resize_job(job):
+    """pool job: write the scaled image, return the new size"""
+    src, dst, scale = job
+    img = cv2.imread(src, cv2.IMREAD_UNCHANGED)
+    height, width = img.shape[:2]
+    size = (max(1, int(width * scale + 0.5)), max(1, int(height * scale + 0.5)))
+    cv2.imwrite(dst, cv2.resize(img, size, interpolation=cv2.INTER_AREA))
+    return [size[1], size[0]]
+
+
+class ResizedImages():
+    """
+    index of the pre-resized images of one folder:
+    name -> signature of the original, scale (x, y) and file of the copy
+    """
+
+    def __init__(self, img_dir):
+        self.img_dir = os.path.abspath(img_dir)
+        self.resize_dir = get_resize_dir(self.img_dir)
+        self.meta_path = os.path.join(self.resize_dir, RESIZE_META)
+        self.meta = {"sizes": None, "images": {}}
+
+        if os.path.isfile(self.meta_path):
+            with open(self.meta_path, 'r') as file:
+                self.meta = json.load(file)
+
+    def lookup(self, path, sizes=None):
+        """
+        (path, (scale_x, scale_y)) of the image to read, (path, None) if it is
+        not prepared or was prepared for other config sizes
+        """
+        if sizes is not None and self.meta["sizes"] != sizes:
+            return path, None
+        name = os.path.basename(path)
+        entry = self.meta["images"].get(name)
+        if entry is None or entry["file"] is None or \
+                entry["signature"] != file_signature(os.path.join(self.img_dir, name)):
+            return path, None
+        return os.path.join(self.resize_dir, entry["file"]), tuple(entry["scale"])
+
+    def prepare(self, names, sizes, infos, workers=1):
+        """
+        scale all missing / changed images of names, infos gives their
+        (height, width). a change of the config sizes rebuilds the folder
+        """
+        if self.meta["sizes"] != sizes:
+            shutil.rmtree(self.resize_dir, ignore_errors=True)
+            self.meta = {"sizes": sizes, "images": {}}
+        os.makedirs(self.resize_dir, exist_ok=True)
+
+        jobs, todo = [], []
+        for name, (height, width) in zip(names, infos):
+            signature = file_signature(os.path.join(self.img_dir, name))
+            entry = self.meta["images"].get(name)
+            if entry is not None and entry["signature"] == signature:
+                continue
+
+            scale = resize_scale(height, width, sizes)
+            if scale >= 1.0:
+                # already small enough -> read the original
+                self.meta["images"][name] = {"signature": signature, "file": None, "scale": [1.0, 1.0]}
+                continue
+            todo.append((name, signature, height, width))
+            jobs.append((os.path.join(self.img_dir, name), os.path.join(self.resize_dir, name), scale))
+
+        for (name, signature, height, width), (new_h, new_w) in zip(
+                todo, map_ordered(resize_job, jobs, workers=workers)):
+            self.meta["images"][name] = {
+                "signature": signature,
+                "file": name,
+                "scale": [new_w / width, new_h / height],
+            }
+
+        tmp_path = f'{self.meta_path}.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(self.meta, file)
+        os.replace(tmp_path, self.meta_path)
+
+        print(f'Pre-resized {len(todo)} of {len(names)} images in {self.resize_dir}')
+
+
+_RESIZED = {}
+
+
+def get_resized_images(img_dir):
+    """one shared index per image folder and process"""
+    img_dir = os.path.abspath(img_dir)
+    if img_dir not in _RESIZED:
+        _RESIZED[img_dir] = ResizedImages(img_dir)
+    return _RESIZED[img_dir]
+
+
+def resized_lookup(path, sizes=None):
+    """pre-resized file and scale of the image at path, (path, None) if there is none"""
+    return get_resized_images(os.path.dirname(path) or '.').lookup(path, sizes)
+
+
+def prepare_resized(paths, cfg, shapes=None, workers=1):
+    """
+    pre-resize the images at paths for the sizes of cfg, per folder.
+    shapes: (height, width) of each image, else read from the png headers
+    """
+    sizes = config_sizes(cfg)
+    if shapes is None:
+        shapes = [(info["height"], info["width"]) for info in map(get_image_info, paths)]
+
+    folders = {}
+    for path, shape in zip(paths, shapes):
+        names, infos = folders.setdefault(os.path.dirname(path) or '.', ([], []))
+        names.append(os.path.basename(path))
+        infos.append(tuple(shape))
+
+    for img_dir, (names, infos) in folders.items():
+        get_resized_images(img_dir).prepare(names, sizes, infos, workers=workers)
+
+
+def rescale_record(dataset_dict, scale, shape):
+    """scale the size, boxes and polygons of a dataset dict to the pre-resized image"""
+    scale_x, scale_y = scale
+    dataset_dict["height"], dataset_dict["width"] = shape[:2]
+    for anno in dataset_dict.get("annotations", []):
+        anno["bbox"] = (np.asarray(anno["bbox"], dtype=np.float64) *
+                        [scale_x, scale_y, scale_x, scale_y]).tolist()
+        if isinstance(anno.get("segmentation"), list):
+            anno["segmentation"] = [
+                (np.asarray(poly, dtype=np.float64).reshape(-1, 2) * [scale_x, scale_y]).ravel()
+                for poly in anno["segmentation"]]
+    return dataset_dict
@@ -0,0 +1,130 @@
+# %%
+#
+#  rle.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-08.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# run length encoding of binary masks in the coco format (column major)
+import numpy as np
+
+
+def run_bounds(mask, offset=(0, 0), size=None):
+    """
+    start and end (exclusive) of all foreground runs in the column major
+    ravel of the full image. mask can be a crop placed at offset = (x, y)
+    inside an image of size = (height, width)
+    """
+    mask = np.asarray(mask) > 0
+    size = mask.shape if size is None else size
+    height = size[0]
+    x_0, y_0 = offset
+
+    # pad a background row above and below -> every run starts and ends in its column
+    padded = np.zeros((mask.shape[0] + 2, mask.shape[1]), dtype=np.int8)
+    padded[1:-1] = mask
+    flat = padded.ravel(order='F')
+    change = np.flatnonzero(np.diff(flat))
+
+    # position inside the padded crop -> position in the full image
+    col, row = np.divmod(change, padded.shape[0])
+    pos = (x_0 + col) * height + y_0 + row
+
+    starts, ends = pos[0::2], pos[1::2]
+
+    # runs touching the bottom and the top of the next column are one run
+    joined = starts[1:] == ends[:-1]
+    if joined.any():
+        starts = np.concatenate([starts[:1], starts[1:][~joined]])
+        ends = np.concatenate([ends[:-1][~joined], ends[-1:]])
+
+    return starts, ends
+
+
+def encode(mask, offset=(0, 0), size=None, compressed=False):
+    """
+    rle of the binary mask, {'counts': [...], 'size': [height, width]}
+    the counts start with the background run, compressed returns the
+    string format of pycocotools
+    """
+    size = list(np.asarray(mask).shape if size is None else size)
+    starts, ends = run_bounds(mask, offset, size)
+
+    bounds = np.empty(2 * len(starts) + 2, dtype=np.int64)
+    bounds[0], bounds[-1] = 0, size[0] * size[1]
+    bounds[1:-1:2], bounds[2:-1:2] = starts, ends
+    counts = np.diff(bounds)
+
+    # a mask ending on the foreground has no trailing background run
+    if len(counts) > 1 and counts[-1] == 0:
+        counts = counts[:-1]
+
+    counts = counts.tolist()
+    return {'counts': compress_counts(counts) if compressed else counts, 'size': size}
+
+
+def decode(rle):
+    """binary uint8 mask of the rle, counts can be a list or a compressed string"""
+    height, width = rle['size']
+    counts = rle['counts']
+    if isinstance(counts, (str, bytes)):
+        counts = decompress_counts(counts)
+
+    bounds = np.cumsum(counts)
+    flat = np.zeros(height * width + 1, dtype=np.int8)
+
+    # +1 at each run start, -1 at each run end -> cumsum is the mask
+    np.add.at(flat, bounds[0::2], 1)
+    np.add.at(flat, bounds[1::2], -1)
+    return np.cumsum(flat[:-1], dtype=np.int8).astype(np.uint8).reshape((width, height)).T
+
+
+def compress_counts(counts):
+    """counts -> string, as rleToString of pycocotools"""
+    chars = []
+    for i, cnt in enumerate(counts):
+        cnt = int(cnt)
+        if i > 2:
+            cnt -= int(counts[i - 2])
+        more = True
+        while more:
+            char = cnt & 0x1f
+            cnt >>= 5
+            more = cnt != -1 if char & 0x10 else cnt != 0
+            if more:
+                char |= 0x20
+            chars.append(chr(char + 48))
+    return ''.join(chars)
+
+
+def decompress_counts(string):
+    """string -> counts, as rleFrPyObjects of pycocotools"""
+    if isinstance(string, bytes):
+        string = string.decode('ascii')
+
+    counts = []
+    pos = 0
+    while pos < len(string):
+        cnt, shift, more = 0, 0, True
+        while more:
+            char = ord(string[pos]) - 48
+            cnt |= (char & 0x1f) << (5 * shift)
+            more = char & 0x20
+            pos += 1
+            shift += 1
+            if not more and char & 0x10:
+                cnt |= -1 << (5 * shift)
+        if len(counts) > 2:
+            cnt += counts[-2]
+        counts.append(cnt)
+    return counts
+
+
+def area(rle):
+    """number of foreground pixels without decoding"""
+    counts = rle['counts']
+    if isinstance(counts, (str, bytes)):
+        counts = decompress_counts(counts)
+    return int(sum(counts[1::2]))
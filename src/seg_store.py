@@ -0,0 +1,224 @@
+# %%
+#
+#  seg_store.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-06.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# store of the segmentations as tight crops, each .seg.nrrd is decoded once
+import os
+import json
+import numpy as np
+import nrrd
+
+if __name__ == '__main__':
+    from image_index import file_signature
+    from parallel import map_ordered
+else:
+    from src.image_index import file_signature
+    from src.parallel import map_ordered
+
+
+NRRD_KEY = 'Segmentation_ReferenceImageExtentOffset'
+STORE_DATA = 'crops.npy'
+STORE_INDEX = 'crops.json'
+
+
+def paste_lut(fac):
+    """
+    pixel values of Image.paste(fg, offset, fg) on a black canvas:
+    the foreground is its own mask -> v * v / 255 with PIL rounding
+    """
+    val = (np.arange(256, dtype=np.uint8) * np.uint8(fac)).astype(np.int64)
+    tmp = val * val + 128
+    return ((tmp + (tmp >> 8)) >> 8).astype(np.uint8)
+
+
+class SegCrop():
+    """
+    segmentation as tight crop (rows = y, cols = x) plus its origin (x, y)
+    in the image
+    """
+
+    def __init__(self, crop, origin):
+        self.crop = crop
+        self.origin = (int(origin[0]), int(origin[1]))
+
+    @property
+    def bbox(self):
+        """[x, y, width, height] of the crop"""
+        return [self.origin[0], self.origin[1], self.crop.shape[1], self.crop.shape[0]]
+
+    @property
+    def area(self):
+        return int(np.count_nonzero(self.crop))
+
+    def clip(self, shape):
+        """the part of the crop inside an image of shape (height, width)"""
+        height, width = shape[:2]
+        x_0, y_0 = self.origin
+        c_h, c_w = self.crop.shape
+        top, left = min(max(y_0, 0), height), min(max(x_0, 0), width)
+        bottom, right = max(min(y_0 + c_h, height), top), max(min(x_0 + c_w, width), left)
+        if (top, left, bottom, right) == (y_0, x_0, y_0 + c_h, x_0 + c_w):
+            return self
+        return SegCrop(self.crop[top - y_0:bottom - y_0, left - x_0:right - x_0], (left, top))
+
+    def to_full(self, shape, fac=None):
+        """
+        expand the crop to an image of shape (height, width), clipped at the
+        image border. fac reproduces the former paste of (label * fac)
+        """
+        height, width = shape[:2]
+        full = np.zeros((height, width), dtype=np.uint8)
+
+        x_0, y_0 = self.origin
+        c_h, c_w = self.crop.shape
+        top, left = max(y_0, 0), max(x_0, 0)
+        bottom, right = min(y_0 + c_h, height), min(x_0 + c_w, width)
+        if bottom <= top or right <= left:
+            return full
+
+        part = self.crop[top - y_0:bottom - y_0, left - x_0:right - x_0]
+        full[top:bottom, left:right] = part if fac is None else paste_lut(fac)[part]
+        return full
+
+
+def read_seg_crop(nrrd_path, nrrd_key=NRRD_KEY):
+    """decode the nrrd and reduce it to the tight crop around the label"""
+    readdata, header = nrrd.read(nrrd_path)
+    seg = np.transpose(readdata[:, :, 0]).astype(np.uint8)
+
+    # get the offsets
+    offset = [int(off) for off in header[nrrd_key].split()[0:2]]
+
+    rows = np.flatnonzero(seg.any(axis=1))
+    cols = np.flatnonzero(seg.any(axis=0))
+    if len(rows) == 0:
+        # keep a single empty pixel, an empty array breaks the PIL consumers
+        return SegCrop(np.zeros((1, 1), dtype=np.uint8), offset)
+
+    crop = seg[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    return SegCrop(np.ascontiguousarray(crop), (offset[0] + cols[0], offset[1] + rows[0]))
+
+
+def _read_job(nrrd_path):
+    """pool job: crop and signature of a single file"""
+    return read_seg_crop(nrrd_path), file_signature(nrrd_path)
+
+
+class SegStore():
+    """
+    all crops of one segmentation folder packed into a single memory
+    mapped array, with an index of name -> (start, shape, origin)
+    """
+
+    def __init__(self, seg_dir):
+        self.seg_dir = seg_dir
+        self.data_path = os.path.join(seg_dir, STORE_DATA)
+        self.index_path = os.path.join(seg_dir, STORE_INDEX)
+        self.index = {}
+        self.data = np.zeros(0, dtype=np.uint8)
+        self.pending = {}
+
+        if os.path.isfile(self.index_path) and os.path.isfile(self.data_path):
+            with open(self.index_path, 'r') as file:
+                packed = json.load(file)
+            data = np.load(self.data_path, mmap_mode='r')
+            # index and data are replaced one after the other -> check they belong together
+            if packed["size"] == data.size:
+                self.index, self.data = packed["crops"], data
+
+    def _is_valid(self, name, signature):
+        entry = self.index.get(name)
+        return entry is not None and entry["signature"] == signature
+
+    def _from_index(self, name):
+        entry = self.index[name]
+        height, width = entry["shape"]
+        start = entry["start"]
+        crop = self.data[start:start + height * width].reshape(height, width)
+        return SegCrop(crop, entry["origin"])
+
+    def get(self, name, nrrd_key=NRRD_KEY):
+        """crop of the segmentation file name, decoded only on a miss"""
+        path = os.path.join(self.seg_dir, name)
+        signature = file_signature(path)
+
+        if name in self.pending and self.pending[name][1] == signature:
+            return self.pending[name][0]
+        if self._is_valid(name, signature):
+            return self._from_index(name)
+
+        seg_crop = read_seg_crop(path, nrrd_key)
+        self.pending[name] = (seg_crop, signature)
+        return seg_crop
+
+    def update(self, names, workers=1):
+        """decode all missing or changed files of names and save the store"""
+        missing = []
+        for name in names:
+            path = os.path.join(self.seg_dir, name)
+            if not os.path.isfile(path) or name in self.pending:
+                continue
+            if not self._is_valid(name, file_signature(path)):
+                missing.append(name)
+
+        paths = [os.path.join(self.seg_dir, name) for name in missing]
+        for name, res in zip(missing, map_ordered(_read_job, paths, workers=workers)):
+            self.pending[name] = res
+
+        self.save()
+
+    def save(self):
+        """repack the crops, only if new ones were decoded"""
+        if not self.pending:
+            return
+
+        crops, index, start = [], {}, 0
+        for name, entry in self.index.items():
+            if name not in self.pending:
+                crops.append(self._from_index(name).crop.ravel())
+                index[name] = dict(entry, start=start)
+                start += crops[-1].size
+        for name, (seg_crop, signature) in self.pending.items():
+            crops.append(seg_crop.crop.ravel())
+            index[name] = {
+                "signature": signature,
+                "start": start,
+                "shape": list(seg_crop.crop.shape),
+                "origin": list(seg_crop.origin),
+            }
+            start += crops[-1].size
+
+        data = np.concatenate(crops) if crops else np.zeros(0, dtype=np.uint8)
+
+        # write to temporary files first, an interrupted save keeps the old store
+        np.save(f'{self.data_path}.tmp.npy', data)
+        with open(f'{self.index_path}.tmp', 'w') as file:
+            json.dump({"size": int(data.size), "crops": index}, file)
+        os.replace(f'{self.data_path}.tmp.npy', self.data_path)
+        os.replace(f'{self.index_path}.tmp', self.index_path)
+
+        self.index = index
+        self.data = np.load(self.data_path, mmap_mode='r')
+        self.pending = {}
+
+
+_STORES = {}
+
+
+def get_seg_store(seg_dir):
+    """one shared store per segmentation folder and process"""
+    seg_dir = os.path.abspath(seg_dir)
+    if seg_dir not in _STORES:
+        _STORES[seg_dir] = SegStore(seg_dir)
+    return _STORES[seg_dir]
+
+
+def get_seg_crop(nrrd_path, nrrd_key=NRRD_KEY):
+    """crop of the segmentation at nrrd_path, through its folder's store"""
+    seg_dir, name = os.path.split(nrrd_path)
+    return get_seg_store(seg_dir or '.').get(name, nrrd_key)
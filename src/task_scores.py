@@ -0,0 +1,109 @@
+# %%
+#
+#  task_scores.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-24.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# accuracy and confusion matrices of all tasks from one array of entity predictions
+import numpy as np
+from scipy.stats import rankdata
+
+if __name__ == '__main__':
+    from categories import cat_naming_new, reverse_cat_list, task_labels, task_probabilities, UNKNOWN_ID
+else:
+    from src.categories import cat_naming_new, reverse_cat_list, task_labels, task_probabilities, UNKNOWN_ID
+
+
+TASK_SIZES = np.array([loc_cat['cat'] for loc_cat in cat_naming_new], dtype=np.int64)
+
+
+def detection_probabilities(classes, scores, num=len(reverse_cat_list)):
+    """entity probabilities of one image: best score per detected class, normalized"""
+    probs = np.zeros(num)
+    np.maximum.at(probs, np.asarray(classes, dtype=np.int64), np.asarray(scores, dtype=np.float64))
+    total = probs.sum()
+    return probs / total if total > 0 else np.full(num, np.nan)
+
+
+def instance_probabilities(instances, num=len(reverse_cat_list)):
+    """
+    class probabilities of the first (best) instance: its pred_probs, from
+    the detection scores if they are missing. a nan row without detections
+    """
+    if len(instances) == 0:
+        return np.full(num, np.nan)
+    if instances.has("pred_probs"):
+        return instances.pred_probs[0].numpy().astype(np.float64)
+    return detection_probabilities(instances.pred_classes.numpy(), instances.scores.numpy(), num)
+
+
+def predicted_ids(probs):
+    """best class of every row of probabilities, -1 (unclassified) for the nan rows"""
+    probs = np.asarray(probs, dtype=np.float64)
+    probs = probs.reshape(len(probs), -1)
+    detected = ~np.isnan(probs).any(axis=1)
+    return np.where(detected, np.nan_to_num(probs, nan=-1.0).argmax(axis=1), UNKNOWN_ID)
+
+
+def ovr_auroc(probs, targets):
+    """
+    one-vs-rest AUROC of every class from (n, classes) probabilities, via
+    the rank sums of all columns at once. nan for classes without positive
+    or negative samples
+    """
+    probs = np.asarray(probs, dtype=np.float64)
+    targets = np.asarray(targets)
+    positive = targets[:, None] == np.arange(probs.shape[1])
+    n_pos = positive.sum(axis=0)
+    n_neg = len(targets) - n_pos
+    ranks = rankdata(probs, axis=0)
+    rank_sum = np.sum(ranks * positive, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (rank_sum - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+
+def task_confusions(targets, preds):
+    """
+    confusion matrices (rows: targets, cols: predictions) of all tasks
+    from (n, tasks) labels in one bincount, unknown labels (-1) are left out
+    """
+    offsets = np.concatenate([[0], np.cumsum(TASK_SIZES ** 2)[:-1]])
+    flat = offsets + targets * TASK_SIZES + preds
+    valid = (targets >= 0) & (preds >= 0)
+    counts = np.bincount(flat[valid], minlength=int(np.sum(TASK_SIZES ** 2)))
+    return [counts[off:off + num ** 2].reshape(num, num) for off, num in zip(offsets, TASK_SIZES)]
+
+
+def multi_task_scores(pred_ids, true_ids, entity_probs=None):
+    """
+    predictions, targets, accuracy and confusion matrix of every task of
+    cat_naming_new. with entity_probs also the task probabilities and the
+    AUROC (binary tasks) / mean one-vs-rest AUROC (multi-class tasks).
+    unclassified images (pred_ids -1, nan probabilities) count as wrong,
+    are left out of the confusion matrices and of the AUROC
+    """
+    preds = task_labels(pred_ids)
+    targets = task_labels(true_ids)
+    correct = (preds == targets) & (preds != UNKNOWN_ID)
+    accs = np.mean(correct, axis=0) if len(preds) else np.zeros(len(TASK_SIZES))
+    confs = task_confusions(targets, preds)
+
+    res = {}
+    for loc_cat in cat_naming_new:
+        cat_index = loc_cat['index']
+        res[loc_cat['name']] = {
+            'conf': confs[cat_index],
+            'acc': float(accs[cat_index]),
+            'preds': preds[:, cat_index],
+            'targets': targets[:, cat_index],
+        }
+        if entity_probs is not None:
+            probs = task_probabilities(entity_probs, cat_index)
+            detected = ~np.isnan(probs).any(axis=1)
+            aurocs = ovr_auroc(probs[detected], targets[detected, cat_index])
+            res[loc_cat['name']]['probs'] = probs
+            res[loc_cat['name']]['auroc'] = float(aurocs[1] if len(aurocs) == 2 else np.nanmean(aurocs))
+    return res
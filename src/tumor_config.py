@@ -0,0 +1,38 @@
+# %%
+#
+#  tumor_config.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-26.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# config options of this repository, registered on the detectron2 config
+
+# the input options and their defaults, all of them are opt-in
+INPUT_DEFAULTS = {
+    # decode and augment one channel, the tensor is expanded to 3 channels
+    'GRAYSCALE': False,
+    # byte budget of the shared-memory cache of decoded images, 0 -> off
+    'IMAGE_CACHE_BYTES': 0,
+    # read the images pre-resized to the largest size the config can request
+    'PRE_RESIZE': False,
+}
+
+
+def add_tumor_config(cfg):
+    """
+    add the input options with their defaults, call it right after get_cfg()
+    so yaml files can set them and typos are rejected by the merge
+    """
+    for key, value in INPUT_DEFAULTS.items():
+        setattr(cfg.INPUT, key, value)
+    return cfg
+
+
+def input_option(cfg, key):
+    """
+    the option of cfg.INPUT, its default for configs built without
+    add_tumor_config (saved configs, a bare get_cfg())
+    """
+    return cfg.INPUT.get(key, INPUT_DEFAULTS[key])
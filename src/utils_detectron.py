@@ -30,13 +30,17 @@ from pycocotools.coco import COCO
 
 # detectron core specific
 from fvcore.common.file_io import PathManager
-from fvcore.transforms.transform import Transform
+from fvcore.transforms.transform import Transform, TransformList
 
 # detectron specific
 from detectron2.data import build_detection_train_loader
+from detectron2.data.build import get_detection_dataset_dicts, build_batch_data_loader
+from detectron2.data.common import MapDataset
+from detectron2.data.samplers import TrainingSampler, RepeatFactorTrainingSampler
 from detectron2.data import transforms as T
 from detectron2.data import detection_utils as utils
 from detectron2.engine import DefaultTrainer
+from detectron2.structures import BoxMode
 from detectron2.evaluation.evaluator import DatasetEvaluator
 from detectron2.evaluation import COCOEvaluator
 from detectron2.data.transforms.augmentation import TransformGen
@@ -44,11 +48,35 @@ from detectron2.data.transforms.augmentation import TransformGen
 
 # personal functionality
 if __name__ == '__main__':
-    from categories import cat_mapping_new, malign_int, benign_int, make_cat_advanced
-    from utils_tumor import get_advanced_dis_data_fr, CLASS_KEY, ENTITY_KEY, F_KEY
+    from categories import entity_ids, task_labels, task_probabilities, make_cat_advanced, \
+        MALIGNANT_TASK, UNKNOWN_ID
+    from task_scores import instance_probabilities, predicted_ids
+    from utils_tumor import get_advanced_dis_data_fr, format_seg_names, CLASS_KEY, ENTITY_KEY, F_KEY
+    from seg_store import get_seg_crop
+    from image_io import read_image
+    from image_cache import ImageCache
+    from packed_images import pack_images
+    from resize_cache import CROP_MIN, config_sizes, prepare_resized, resized_lookup, rescale_record
+    from batch_predict import predict_files
+    from records import CompactRecords
+    from metrics import xywh_to_xyxy, box_iou_dice, empty_crop, mask_crop, crop_iou_dice
+    from tumor_config import input_option
+    from bootstrap import N_BOOT, resample_idx, interval, boot_mean, boot_auroc
 else:
-    from src.categories import cat_mapping_new, malign_int, benign_int, make_cat_advanced
-    from src.utils_tumor import get_advanced_dis_data_fr, CLASS_KEY, ENTITY_KEY, F_KEY
+    from src.categories import entity_ids, task_labels, task_probabilities, make_cat_advanced, \
+        MALIGNANT_TASK, UNKNOWN_ID
+    from src.task_scores import instance_probabilities, predicted_ids
+    from src.utils_tumor import get_advanced_dis_data_fr, format_seg_names, CLASS_KEY, ENTITY_KEY, F_KEY
+    from src.seg_store import get_seg_crop
+    from src.image_io import read_image
+    from src.image_cache import ImageCache
+    from src.packed_images import pack_images
+    from src.resize_cache import CROP_MIN, config_sizes, prepare_resized, resized_lookup, rescale_record
+    from src.batch_predict import predict_files
+    from src.records import CompactRecords
+    from src.metrics import xywh_to_xyxy, box_iou_dice, empty_crop, mask_crop, crop_iou_dice
+    from src.tumor_config import input_option
+    from src.bootstrap import N_BOOT, resample_idx, interval, boot_mean, boot_auroc
 
 
 class MyEvaluator(DatasetEvaluator):
@@ -195,91 +223,321 @@ class RandomRot(TransformGen):
         # return rotation operation
         return RotTransform(ang, height=height, width=width)
 
-# %%
+# %% Crop, resize, flip and rotation in one warp:
 
 
-def softmax(x_var):
-    """softmax norm vector to 1"""
-    return np.exp(x_var)/sum(np.exp(x_var))
+class FusedAffineTransform(Transform):
+    """
+    crop, resize, flips and rotation as one affine matrix, the image is
+    resampled only once with OpenCV
+    """
 
+    def __init__(self, crop, out_size, hflip, vflip, degree):
+        """
+        Args:
+            crop (tuple): x0, y0, width, height of the crop in the input image
+            out_size (tuple): height, width after resizing the crop
+            hflip, vflip (bool): flip the resized crop
+            degree (float): counter-clockwise rotation about (w // 2, h // 2)
+        """
+        super().__init__()
+        self.crop = crop
+        self.out_size = out_size
+        self.hflip, self.vflip, self.degree = hflip, vflip, degree
+
+        x_0, y_0, c_w, c_h = crop
+        out_h, out_w = out_size
+
+        # flips and rotation of the resized crop, in continuous coordinates
+        sind = math.sin(degree * (math.pi / 180))
+        cosd = math.cos(degree * (math.pi / 180))
+        center_x, center_y = out_w // 2, out_h // 2
+        flip = np.array([[-1. if hflip else 1., 0., out_w if hflip else 0.],
+                         [0., -1. if vflip else 1., out_h if vflip else 0.],
+                         [0., 0., 1.]])
+        rot = np.array([[cosd, sind, center_x - cosd * center_x - sind * center_y],
+                        [-sind, cosd, center_y + sind * center_x - cosd * center_y],
+                        [0., 0., 1.]])
+        self.post = rot @ flip
+
+        # crop and resize before
+        scale = np.array([[out_w / c_w, 0., -x_0 * out_w / c_w],
+                          [0., out_h / c_h, -y_0 * out_h / c_h],
+                          [0., 0., 1.]])
+        self.matrix = self.post @ scale
 
-def get_active_idx(data_fr, mode, external=False):
-    """Get the currently active indexes depending on the dataset mode(=test)"""
-    dis = get_advanced_dis_data_fr(data_fr, mode=external)
-    # get the indices of the dataset
-    if mode == "test":
-        active_idx = dis["test"]["idx"]
-    elif mode == "valid":
-        active_idx = dis["valid"]["idx"]
-    elif mode == 'train':
-        active_idx = dis["train"]["idx"]
-    else:
-        active_idx = dis["test_external"]["idx"]
+    @staticmethod
+    def pixel_matrix(matrix):
+        """continuous matrix -> matrix on the pixel indices (pixel centers at +0.5)"""
+        lin = matrix[:2, :2]
+        return np.hstack([lin, matrix[:2, 2:] + lin.sum(axis=1, keepdims=True) * 0.5 - 0.5])
+
+    def _warp(self, img, interp, pre_interp):
+        x_0, y_0, c_w, c_h = self.crop
+        out_h, out_w = self.out_size
+        view = img[y_0:y_0 + c_h, x_0:x_0 + c_w]
+
+        if pre_interp is not None and (out_w < c_w or out_h < c_h):
+            # downscaling -> area average of the crop view, then only flips / rotation
+            view = cv2.resize(view, (out_w, out_h), interpolation=pre_interp)
+            matrix = self.post
+        else:
+            # the view starts at the crop origin
+            matrix = self.matrix @ np.array([[1., 0., x_0], [0., 1., y_0], [0., 0., 1.]])
 
-    return active_idx
+        out = cv2.warpAffine(view, self.pixel_matrix(matrix), (out_w, out_h),
+                             flags=interp, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        if img.ndim == 3 and out.ndim == 2:
+            out = out[:, :, None]
+        return out
+
+    def apply_image(self, img: np.ndarray) -> np.ndarray:
+        """
+        Crop, resize, flip and rotate the image in one pass.
+        Args:
+            img (ndarray): of shape HxW or HxWxC (C <= 4)
+        Returns:
+            ndarray: the transformed image.
+        """
+        return self._warp(img, cv2.INTER_LINEAR, cv2.INTER_AREA)
+
+    def apply_segmentation(self, segmentation: np.ndarray) -> np.ndarray:
+        """labels are sampled with nearest neighbour only"""
+        return self._warp(segmentation, cv2.INTER_NEAREST, None)
+
+    def apply_coords(self, coords: np.ndarray) -> np.ndarray:
+        """
+        Transform the coordinates.
+        Args:
+            coords (ndarray): floating point array of shape Nx2. Each row is
+                (x, y).
+        Returns:
+            ndarray: new array of the transformed coordinates.
+        """
+        coords = np.asarray(coords, dtype=np.float64)
+        return coords @ self.matrix[:2, :2].T + self.matrix[:2, 2]
 
 
-def auroc_helper(out, pred, entity, targets2, preds2, count2, pred_score):
+class RandomFusedGeometry(TransformGen):
     """
-    determine the softmax score between first guess and second unequal guess
+    Random crop (relative range), shortest edge resize, flips and rotation,
+    sampled like RandomCrop, ResizeShortestEdge, RandomFlip and RandomRot
+    and applied as a single FusedAffineTransform
     """
-    cla_malig = (
-        1 if entity in [
-            "Chondrosarkom",
-            "Osteosarkom",
-            "Ewing-Sarkom",
-            "Plasmozytom / Multiples Myelom",
-            "NHL vom B-Zell-Typ",
-        ] else 0
-    )
-    targets2.append(cla_malig)
 
-    pred_malig = 1 if pred in [0, 1, 2, 3, 4] else 0
-    preds2.append(pred_malig)
-    correct = 1 if cla_malig == pred_malig else 0
-    count2 += correct
+    def __init__(self, min_size, max_size, sample_style="choice", crop_size=(0.7, 1.0),
+                 hflip_prob=0.5, vflip_prob=0.5, deg_range=60):
+        super().__init__()
+        self.min_size = min_size
+        self.max_size = max_size
+        self.sample_style = sample_style
+        self.crop_size = crop_size
+        self.hflip_prob, self.vflip_prob = hflip_prob, vflip_prob
+        self.deg_range = deg_range
 
-    # further get the score
-    score_0 = out[:1].scores[0]
-    score_1 = out[:1].scores[0]
+    def get_crop(self, height, width):
+        """relative_range crop as T.RandomCrop: (x0, y0, width, height)"""
+        crop_min = np.asarray(self.crop_size, dtype=np.float32)
+        crop_h, crop_w = crop_min + np.random.rand(2) * (1 - crop_min)
+        c_h, c_w = int(height * crop_h + 0.5), int(width * crop_w + 0.5)
+        y_0 = np.random.randint(height - c_h + 1)
+        x_0 = np.random.randint(width - c_w + 1)
+        return int(x_0), int(y_0), c_w, c_h
+
+    def get_size(self, height, width):
+        """output size of the crop as T.ResizeShortestEdge"""
+        if self.sample_style == "range":
+            size = np.random.randint(self.min_size[0], self.min_size[1] + 1)
+        else:
+            size = np.random.choice(self.min_size)
+        if size == 0:
+            return height, width
 
-    copy_correct = correct
-    loc_count = 1
+        scale = size * 1.0 / min(height, width)
+        if height < width:
+            newh, neww = size, scale * width
+        else:
+            newh, neww = scale * height, size
+        if max(newh, neww) > self.max_size:
+            scale = self.max_size * 1.0 / max(newh, neww)
+            newh, neww = newh * scale, neww * scale
+        return int(newh + 0.5), int(neww + 0.5)
 
-    # go trough the other suggestions and pic one uneqaul to the first
-    while correct == copy_correct and loc_count < 100:
-        pred_loc = out[loc_count].pred_classes[0]
-        score_0 = out[loc_count].scores[0]
-        pred_malig = 1 if pred_loc in [0, 1, 2] else 0
-        copy_correct = 1 if cla_malig == pred_malig else 0
-        loc_count += 1
+    def get_transform(self, img):
+        height, width = img.shape[:2]
+        crop = self.get_crop(height, width)
+        out_size = self.get_size(crop[3], crop[2])
+        hflip = np.random.uniform() < self.hflip_prob
+        vflip = np.random.uniform() < self.vflip_prob
+        ang = random.uniform(-self.deg_range, self.deg_range)
+        return FusedAffineTransform(crop, out_size, hflip, vflip, ang)
 
-    pred_score.append(softmax([score_0, score_1])[correct])
+# %% Lighting, brightness, contrast and saturation in one pass:
 
-    return count2
 
+# as T.RandomLighting / T.RandomSaturation
+EIGEN_VECS = np.array([[-0.5675, 0.7192, 0.4009],
+                       [-0.5808, -0.0045, -0.8140],
+                       [-0.5836, -0.6948, 0.4203]])
+EIGEN_VALS = np.array([0.2175, 0.0188, 0.0045])
+LUMA = np.array([0.299, 0.587, 0.114])
 
-def check_if_correct(pred_int, true_int):
-    """outsourced checking func"""
-    loc = 0
-    if (pred_int in malign_int) and (true_int in malign_int):
-        loc += 1
-    if (pred_int in benign_int) and (true_int in benign_int):
-        loc += 1
-    return loc
 
+def blend(src_image, src_weight, dst_weight, img):
+    """T.BlendTransform.apply_image: clipped and truncated for uint8"""
+    if img.dtype == np.uint8:
+        img = src_weight * src_image + dst_weight * img.astype(np.float32)
+        return np.clip(img, 0, 255).astype(np.uint8)
+    return src_weight * src_image + dst_weight * img
 
-def get_cla_map(simple, entity, true_int, cat_mapping, malignant):
-    """define the class mapping"""
-    # get the mapped integer
-    cla = cat_mapping[malignant] if simple else cat_mapping[entity]
-    if simple:
-        cla = 1 if true_int in malign_int else 0
 
-    return cla
+class FusedPhotometricTransform(Transform):
+    """
+    lighting, brightness, contrast and saturation as the detectron2 stack.
+    images with equal channels (all radiographs) go through one uint8 lookup
+    table, others through the four blends in turn. both give the pixels of
+    the sequential stack
+    """
 
+    def __init__(self, light, bright, contrast, satur, region=None):
+        """
+        Args:
+            light (ndarray): per channel offset of the lighting
+            bright, contrast, satur (float): blend weights
+            region (tuple): x0, y0, width, height the contrast mean is taken
+                over (the later crop), None for the whole image
+        """
+        super().__init__()
+        self.light = light
+        self.bright, self.contrast, self.satur = bright, contrast, satur
+        self.region = region
+
+    def _mean_view(self, img):
+        """the part of the image the contrast mean is taken over"""
+        if self.region is None:
+            return img
+        x_0, y_0, width, height = self.region
+        return img[y_0:y_0 + height, x_0:x_0 + width]
+
+    def _offset(self, channels):
+        """single channel images get the luma of the lighting offset"""
+        return self.light if channels == 3 else np.array([LUMA.dot(self.light)])
+
+    def lookup_table(self, hist, channels=3):
+        """(256, channels) output values of every gray value, hist gives the contrast mean"""
+        ramp = np.repeat(np.arange(256, dtype=np.uint8)[:, None], channels, axis=1)
+        ramp = blend(self._offset(channels), 1.0, 1.0, ramp)
+        ramp = blend(0, 1 - self.bright, self.bright, ramp)
+
+        # mean of the image = histogram weighted mean of the table, exact in integers.
+        # a float64 scalar like ndarray.mean, the blend promotes the same way
+        total = int((hist.astype(np.int64) @ ramp.astype(np.int64)).sum())
+        mean = np.float64(total) / (int(hist.sum()) * channels)
+        ramp = blend(mean, 1 - self.contrast, self.contrast, ramp)
+
+        if channels == 3:
+            ramp = blend(ramp.dot(LUMA)[:, np.newaxis], 1 - self.satur, self.satur, ramp)
+        return ramp
+
+    def _apply_float(self, img):
+        """the four blends one after another, with the dtypes of the detectron2 stack"""
+        channels = img.shape[2] if img.ndim == 3 else 1
+        offset = self._offset(channels)
+        img = blend(offset if img.ndim == 3 else offset[0], 1.0, 1.0, img)
+        img = blend(0, 1 - self.bright, self.bright, img)
+        img = blend(self._mean_view(img).mean(), 1 - self.contrast, self.contrast, img)
+        if channels == 3:
+            img = blend(img.dot(LUMA)[:, :, np.newaxis], 1 - self.satur, self.satur, img)
+        return img
+
+    def apply_image(self, img: np.ndarray) -> np.ndarray:
+        """
+        Apply all four blends.
+        Args:
+            img (ndarray): of shape HxW, HxWx1 or HxWx3
+        Returns:
+            ndarray: the augmented image.
+        """
+        if img.dtype == np.uint8:
+            if img.ndim == 2 or img.shape[2] == 1:
+                gray = img.reshape(img.shape[:2])
+                hist = np.bincount(self._mean_view(gray).ravel(), minlength=256)
+                lut = self.lookup_table(hist, channels=1)
+                return lut[:, 0][img]
+            if img.shape[2] == 3 and np.array_equal(img[:, :, 0], img[:, :, 1]) and \
+                    np.array_equal(img[:, :, 0], img[:, :, 2]):
+                gray = img[:, :, 0]
+                hist = np.bincount(self._mean_view(gray).ravel(), minlength=256)
+                lut = self.lookup_table(hist, channels=3)
+                return lut[gray]
+        return self._apply_float(img)
+
+    def apply_coords(self, coords: np.ndarray) -> np.ndarray:
+        return coords
+
+    def apply_segmentation(self, segmentation: np.ndarray) -> np.ndarray:
+        return segmentation
+
+
+class RandomPhotometric(TransformGen):
+    """
+    samples the parameters like T.RandomLighting, T.RandomBrightness,
+    T.RandomContrast and T.RandomSaturation (in this order)
+    """
+
+    def __init__(self, light_scale=3, bright=(0.9, 1.1), contrast=(0.9, 1.1), satur=(0.7, 1.3)):
+        super().__init__()
+        self.light_scale = light_scale
+        self.bright, self.contrast, self.satur = bright, contrast, satur
+
+    def get_transform(self, img):
+        weights = np.random.normal(scale=self.light_scale, size=3)
+        light = EIGEN_VECS.dot(weights * EIGEN_VALS)
+        bright = np.random.uniform(*self.bright)
+        contrast = np.random.uniform(*self.contrast)
+        satur = np.random.uniform(*self.satur)
+        return FusedPhotometricTransform(light, bright, contrast, satur)
+
+
+class RandomFusedAugmentation(TransformGen):
+    """
+    the photometric blends before the geometric warp, as in the sequential
+    stack (crop, resize, flips, photometric, rotation): the contrast mean is
+    taken over the crop only and the rotation border stays black
+    """
 
-def personal_score(predictor, data_fr, mode="test", simple=True, imgpath="./PNG", external=False):
+    def __init__(self, photometric, geometry):
+        super().__init__()
+        self.photometric = photometric
+        self.geometry = geometry
+
+    def get_transform(self, img):
+        warp = self.geometry.get_transform(img)
+        photo = self.photometric.get_transform(img)
+        photo.region = warp.crop
+        return TransformList([photo, warp])
+
+# %%
+
+
+def get_active_idx(data_fr, mode, external=False):
+    """Get the currently active indexes depending on the dataset mode(=test)"""
+    dis = get_advanced_dis_data_fr(data_fr, mode=external)
+    # get the indices of the dataset
+    if mode == "test":
+        active_idx = dis["test"]["idx"]
+    elif mode == "valid":
+        active_idx = dis["valid"]["idx"]
+    elif mode == 'train':
+        active_idx = dis["train"]["idx"]
+    else:
+        active_idx = dis["test_external"]["idx"]
+
+    return active_idx
+
+
+def personal_score(predictor, data_fr, mode="test", simple=True, imgpath="./PNG", external=False,
+                   batch_size=8, n_boot=N_BOOT):
     """define the accuracy"""
     # get the dataset distribution
     active_idx = get_active_idx(data_fr, mode, external=external)
@@ -292,65 +550,58 @@ def personal_score(predictor, data_fr, mode="test", simple=True, imgpath="./PNG"
 
     # apply the category mapping dep. on simple-mode
     _, cat_mapping = make_cat_advanced(simple)
+    num_classes = predictor.cfg.MODEL.ROI_HEADS.NUM_CLASSES
 
-    # counters during evaluation
-    count, count2 = 0, 0
-
-    # to be filled arrays
-    preds, preds2, targets, targets2 = [], [], [], []
-
-    # auroc score (how likely compared to other solution)
-    pred_score = []
-
-    # Go over the whole dataset
-    for idx in tqdm(active_idx):
-        with torch.no_grad():
-            # load image
-            img = cv2.imread(files[idx])
-            outputs = predictor(img)
-
-            # get predicitions
-            out = outputs["instances"].to("cpu")
-            pred = out[:1].pred_classes[0]
-            pred = pred if simple else pred + 1
-
-        preds.append(pred)
+    # class probabilities of the first instance, batched predictions loaded in the background
+    results = predict_files(predictor, [files[idx] for idx in active_idx], batch_size=batch_size)
+    probs = np.array([instance_probabilities(outputs["instances"].to("cpu"), num_classes)
+                      for _, outputs in tqdm(results, total=len(active_idx))])
+    # images without any detection stay unclassified (-1): wrong, but not in the AUROC
+    pred_cls = predicted_ids(probs)
+    detected = pred_cls != UNKNOWN_ID
 
-        # select the relevant name from the data_fr
-        malignant = data_fr[CLASS_KEY][idx]
-        entity = data_fr[ENTITY_KEY][idx]
-
-        _ = auroc_helper(out, pred, entity, targets2,
-                         preds2, count2, pred_score)
-
-        pred_int = pred
-        true_int = cat_mapping_new[entity][0]
-        count2 += check_if_correct(pred_int, true_int)
-
-        # get the mapped integer
-        cla = get_cla_map(simple, entity, true_int, cat_mapping, malignant)
-        targets.append(cla)
-        # increase count if true
-        count += 1 if cla == pred else 0
+    entities = data_fr[ENTITY_KEY].to_numpy()[active_idx]
+    true_ids = entity_ids(entities)
 
+    # simple: the classes are the trained benign / malign labels (CLASS_KEY), else
+    # the entities, scored as benign / malign by the 'malignant' task
     if simple:
-        targets2 = targets
-        preds2 = preds
+        preds = pred_cls
+        targets = data_fr[CLASS_KEY].to_numpy()[active_idx].astype(int)
+        targets2, preds2, malign_score = targets, preds, probs[:, 1]
+    else:
+        preds = np.where(detected, pred_cls + 1, UNKNOWN_ID)
+        targets = np.array([cat_mapping[entity] for entity in entities])
+        targets2 = task_labels(true_ids, MALIGNANT_TASK)
+        preds2 = task_labels(pred_cls, MALIGNANT_TASK)
+        malign_score = task_probabilities(probs, MALIGNANT_TASK)[:, 1]
 
-    fpr, tpr, _ = roc_curve(targets2, pred_score)
+    fpr, tpr, _ = roc_curve(targets2[detected], malign_score[detected])
     auc_score = auc(fpr, tpr)
 
-    conf = confusion_matrix(targets, preds)
-    conf2 = confusion_matrix(targets2, preds2)
+    # all intervals on the same resamples, drawn within the entities
+    correct = np.stack([preds == targets, preds2 == targets2], axis=1) & detected[:, None]
+    boot_idx = resample_idx(len(true_ids), n_boot, strata=true_ids)
+    acc_lows, acc_highs = interval(boot_mean(correct, boot_idx))
+    auc_low, auc_high = interval(boot_auroc(targets2, malign_score, boot_idx))
+
+    # the unclassified images are left out of the confusion matrices
+    conf = confusion_matrix(targets, preds, labels=np.union1d(targets, preds[detected]))
+    conf2 = confusion_matrix(targets2, preds2, labels=np.union1d(targets2, preds2[detected]))
 
     res = {
         "preds": preds,
         "targets": targets,
-        "acc": count / len(active_idx),
-        "acc2": count2 / len(active_idx),
+        "probs": probs,
+        "acc": float(np.mean(correct[:, 0])),
+        "acc2": float(np.mean(correct[:, 1])),
+        "acc_ci": (acc_lows[0], acc_highs[0]),
+        "acc2_ci": (acc_lows[1], acc_highs[1]),
+        "unclassified": int(np.sum(~detected)),
         "conf": conf,
         "conf2": conf2,
         "rocauc": (fpr, tpr, auc_score),
+        "rocauc_ci": (auc_low, auc_high),
     }
 
     return res
@@ -418,39 +669,52 @@ def plot_confusion_matrix(
 # %%
 
 
-def get_dicts_from_coco(imgdir="../PNG2", mode="train"):
-    """Custom Dataset Functionality for Detectron"""
+def get_dicts_from_coco(imgdir="../PNG2", mode="train", pack=False):
+    """
+    Custom Dataset Functionality for Detectron,
+    pack=True packs the images of imgdir for zero-copy reading
+    """
 
     # load json
     json_file = f"../{mode}.json"
     with open(json_file) as file:
         coco_data = json.load(file)
 
+    # annotations per image
+    img_anns = {}
+    for anns in coco_data["annotations"]:
+        img_anns.setdefault(anns["image_id"], []).append(anns)
+
     # create the list of dictionaries
     dataset_dict = []
 
     # itearte over all images
-    for img, anns in zip(coco_data["images"], coco_data["annotations"]):
+    for img in coco_data["images"]:
         # collect the data
-        filename = os.path.join(imgdir, img["filename"])
+        filename = os.path.join(imgdir, img["file_name"])
         # transcript anns ot obj
-        obj = {
+        objs = [{
             "bbox": anns["bbox"],
+            "bbox_mode": BoxMode.XYWH_ABS,
+            "category_id": anns["category_id"],
             "iscrowd": anns["iscrowd"],
             "segmentation": anns["segmentation"],
             "area": anns["area"]
-        }
+        } for anns in img_anns.get(img["id"], [])]
         # write the data to the dictionary
         record = {
             "file_name": filename,
             "image_id": img["id"],
             "height": img["height"],
             "width": img["width"],
-            "annotations": obj,
+            "annotations": objs,
         }
         # append the dictionary to the running list
         dataset_dict.append(record)
 
+    if pack:
+        pack_images(imgdir, [img["file_name"] for img in coco_data["images"]])
+
     # finally return the list
     return dataset_dict
 
@@ -481,7 +745,7 @@ class MyDatasetMapper():
     https://detectron2.readthedocs.io/_modules/detectron2/data/dataset_mapper.html#DatasetMapper
     """
 
-    def __init__(self, cfg, is_train=True):
+    def __init__(self, cfg, is_train=True, copy_records=True):
         if cfg.INPUT.CROP.ENABLED and is_train:
             self.crop_gen = T.RandomCrop(
                 cfg.INPUT.CROP.TYPE, cfg.INPUT.CROP.SIZE)
@@ -493,6 +757,12 @@ class MyDatasetMapper():
 
         # fmt: off
         self.img_format = cfg.INPUT.FORMAT
+        self.gray = input_option(cfg, 'GRAYSCALE')
+        # decoded images shared by all workers, off if no byte budget is set
+        cache_bytes = input_option(cfg, 'IMAGE_CACHE_BYTES')
+        self.cache = ImageCache(cache_bytes) if cache_bytes > 0 else None
+        # read the images pre-resized for the config sizes, if prepared
+        self.sizes = config_sizes(cfg) if input_option(cfg, 'PRE_RESIZE') else None
         self.mask_on = cfg.MODEL.MASK_ON
         self.mask_format = cfg.INPUT.MASK_FORMAT
         self.keypoint_on = cfg.MODEL.KEYPOINT_ON
@@ -513,6 +783,8 @@ class MyDatasetMapper():
                 else cfg.DATASETS.PRECOMPUTED_PROPOSAL_TOPK_TEST
             )
         self.is_train = is_train
+        # CompactRecords build a new dict per sample -> no deepcopy needed
+        self.copy_records = copy_records
 
     def do_annotations(self, dataset_dict, loc_transforms, loc_image_shape):
         """add annotations if required"""
@@ -550,11 +822,19 @@ class MyDatasetMapper():
         Returns:
             dict: a format that builtin models in detectron2 accept
         """
-        dataset_dict = copy.deepcopy(
-            dataset_dict)  # it will be modified by code below
+        if self.copy_records:
+            dataset_dict = copy.deepcopy(
+                dataset_dict)  # it will be modified by code below
         # USER: Write your own image loading if it's not from a file
-        image = utils.read_image(
-            dataset_dict["file_name"], format=self.img_format)
+        # gray: one channel through decoding and augmentation
+        file_name, scale = dataset_dict["file_name"], None
+        if self.sizes is not None:
+            file_name, scale = resized_lookup(file_name, self.sizes)
+        image = read_image(
+            file_name, gray=self.gray, img_format=self.img_format, cache=self.cache)
+        if scale is not None:
+            # size, boxes and polygons in the coordinates of the smaller image
+            dataset_dict = rescale_record(dataset_dict, scale, image.shape)
         utils.check_image_size(dataset_dict, image)
 
         if "annotations" not in dataset_dict:
@@ -582,6 +862,9 @@ class MyDatasetMapper():
         # Therefore it's important to use torch.Tensor.
         dataset_dict["image"] = torch.as_tensor(
             np.ascontiguousarray(image.transpose(2, 0, 1)))
+        if self.gray:
+            # 3 channels as view, the workers only share the single channel
+            dataset_dict["image"] = dataset_dict["image"].expand(3, -1, -1)
 
         # USER: Remove if you don't use pre-computed proposals.
         if self.load_proposals:
@@ -623,33 +906,21 @@ def build_transform_gen(cfg, is_train):
     logger = logging.getLogger(__name__)
     tfm_gens = []
 
-    # always set to uniform scale
-    tfm_gens.append(T.ResizeShortestEdge(min_size, max_size, sample_style))
-
     # add all the personalized transformations for training here:
     if is_train:
-        # Crop
-        tfm_gens.insert(0, (T.RandomCrop(
-            crop_type="relative_range", crop_size=[0.7, 1])))
-        # Horizontal
-        tfm_gens.append(T.RandomFlip(horizontal=True))
-        # Vertical
-        tfm_gens.append(T.RandomFlip(horizontal=False, vertical=True))
-        # Lightning
-        tfm_gens.append(T.RandomLighting(scale=3))
-        # Brightness
-        tfm_gens.append(T.RandomBrightness(0.9, 1.1))
-        # Contrast
-        tfm_gens.append(T.RandomContrast(0.9, 1.1))
-        # Intensity
-        tfm_gens.append(T.RandomSaturation(
-            intensity_min=0.7, intensity_max=1.3))
-        # NEW: Rotation
-        tfm_gens.append(RandomRot(deg_range=60))
+        # Lightning, brightness, contrast and intensity in one pass, then
+        # crop, uniform scale, horizontal / vertical flip and rotation in one warp
+        tfm_gens.append(RandomFusedAugmentation(
+            RandomPhotometric(light_scale=3, bright=(0.9, 1.1), contrast=(0.9, 1.1), satur=(0.7, 1.3)),
+            RandomFusedGeometry(
+                min_size, max_size, sample_style, crop_size=(CROP_MIN, 1.0), deg_range=60)))
 
         logger.info("TransformGens used in training: %s", str(tfm_gens))
 
         print(tfm_gens)
+    else:
+        # always set to uniform scale
+        tfm_gens.append(T.ResizeShortestEdge(min_size, max_size, sample_style))
 
     return tfm_gens
 
@@ -659,14 +930,65 @@ def get_dataloader(cfg, is_train):
     """
     summarize all functionality in the dataloader
     """
-    mapper = MyDatasetMapper(cfg, is_train)
-    data_loader = build_detection_train_loader(cfg, mapper=mapper)
+    dataset_dicts = get_detection_dataset_dicts(
+        cfg.DATASETS.TRAIN,
+        filter_empty=cfg.DATALOADER.FILTER_EMPTY_ANNOTATIONS,
+        min_keypoints=cfg.MODEL.ROI_KEYPOINT_HEAD.MIN_KEYPOINTS_PER_IMAGE
+        if cfg.MODEL.KEYPOINT_ON else 0,
+        proposal_files=cfg.DATASETS.PROPOSAL_FILES_TRAIN if cfg.MODEL.LOAD_PROPOSALS else None,
+    )
+
+    # scale the images once to the largest size the config can request
+    if input_option(cfg, 'PRE_RESIZE'):
+        prepare_resized(
+            [record["file_name"] for record in dataset_dicts], cfg,
+            shapes=[(record["height"], record["width"]) for record in dataset_dicts],
+            workers=max(1, cfg.DATALOADER.NUM_WORKERS))
+
+    sampler_name = cfg.DATALOADER.SAMPLER_TRAIN
+    if sampler_name not in ("TrainingSampler", "RepeatFactorTrainingSampler"):
+        logging.getLogger(__name__).info(
+            "CompactRecords skipped: sampler %s is built by detectron2", sampler_name)
+        mapper = MyDatasetMapper(cfg, is_train)
+        return build_detection_train_loader(cfg, mapper=mapper)
+
+    # the repeat factors need the category ids of the original dicts
+    if sampler_name == "RepeatFactorTrainingSampler":
+        repeat_factors = RepeatFactorTrainingSampler.repeat_factors_from_category_frequency(
+            dataset_dicts, cfg.DATALOADER.REPEAT_THRESHOLD)
+        sampler = RepeatFactorTrainingSampler(repeat_factors)
+    else:
+        sampler = TrainingSampler(len(dataset_dicts))
+
+    # flat arrays instead of a list of dicts, each sample is a fresh dict
+    records = CompactRecords(dataset_dicts)
+    mapper = MyDatasetMapper(cfg, is_train, copy_records=False)
+    dataset = MapDataset(records, mapper)
+
+    data_loader = build_batch_data_loader(
+        dataset,
+        sampler,
+        cfg.SOLVER.IMS_PER_BATCH,
+        aspect_ratio_grouping=cfg.DATALOADER.ASPECT_RATIO_GROUPING,
+        num_workers=cfg.DATALOADER.NUM_WORKERS,
+    )
     return data_loader
 
 # %% Evaluation:
 
 
-def eval_iou_dice(predictor, data_fr, proposed=1, mode="test"):
+def top_box_crop(instances):
+    """
+    xyxy box and the mask crop inside of it of the first instance, a zero
+    box and an empty crop (IoU and Dice 0) if nothing was detected
+    """
+    if len(instances) == 0:
+        return np.zeros(4), empty_crop()
+    pred_box = instances.pred_boxes.tensor[0].numpy()
+    return pred_box, mask_crop(instances.pred_masks[0].numpy(), pred_box)
+
+
+def eval_iou_dice(predictor, data_fr, proposed=1, mode="test", seg_path="./SEG", batch_size=8):
     """
     Calculate the IoU and Dice Score for the predictor on the <proposed number>
     """
@@ -679,89 +1001,45 @@ def eval_iou_dice(predictor, data_fr, proposed=1, mode="test"):
 
     coco = COCO(f'{mode}.json')
 
-    ious_box = []
-    dices_box = []
+    pred_boxes, true_boxes = [], []
+    pred_crops, true_crops = [], []
 
-    ious_mask = []
-    dices_mask = []
+    results = predict_files(predictor, [file_list[idx] for idx in active_idx], batch_size=batch_size)
 
     # go over all segmentations
-    for i, idx in tqdm(enumerate(active_idx)):
-        img = cv2.imread(file_list[idx])
-        outputs = predictor(img)
+    for i, (idx, (_, outputs)) in tqdm(enumerate(zip(active_idx, results)), total=len(active_idx)):
         instances = outputs["instances"].to("cpu")[:proposed]
 
         # PREDICTION
-        # bbox
-        pred_box = instances.pred_boxes.tensor[0].numpy()
-
-        # mask
-        pred_mask = instances.pred_masks[0].numpy()
+        # bbox, the mask only inside of it
+        pred_box, pred_crop = top_box_crop(instances)
+        pred_boxes.append(pred_box)
+        pred_crops.append(pred_crop)
 
         # GROUND TRUTH
         truth = true_data['annotations'][i]
         # box
-        truth_bbox = truth['bbox']
-        truth_bbox = np.array([truth_bbox[0], truth_bbox[1],
-                               truth_bbox[2], truth_bbox[3]])
-        # mask
-        try:
-            true_mask = coco.annToMask(truth)
-        except FileNotFoundError:
-            true_mask = pred_mask * 0
-
-        # RESULT
-        iou_box, dice_box = bb_iou_dice(pred_box, truth_bbox)
-        iou_box, dice_box = max(0, iou_box), max(0, dice_box)
-
-        iou_mask, dice_mask = mask_iou_dice(
-            pred_mask, true_mask)
-        iou_mask, dice_mask = max(0, iou_mask), max(0, dice_mask)
-
-        # append
-        ious_box.append(iou_box)
-        dices_box.append(dice_box)
-
-        ious_mask.append(iou_mask)
-        dices_mask.append(dice_mask)
-
-    return ious_box, dices_box, ious_mask, dices_mask
-
-
-def bb_iou_dice(boxa, boxb):
-    """IoU and Dice for bbox"""
-    x_min = max(boxa[0], boxb[0])
-    y_min = max(boxa[1], boxb[1])
-    x_max = min(boxa[2], boxb[0] + boxb[2])
-    y_max = min(boxa[3], boxb[1] + boxb[3])
-
-    inter_area = (x_max - x_min) * (y_max - y_min)
-
-    boxa_area = (boxa[2]-boxa[0]) * (boxa[3] - boxa[1])
-    boxb_area = boxb[2] * boxb[3]
-
-    iou = inter_area / float(boxa_area + boxb_area - inter_area)
-    dice = (2 * inter_area) / float(boxa_area + boxb_area)
-
-    return iou, dice
-
-
-def mask_iou_dice(maska, maskb):
-    """IoU and Dice for mask"""
-    maska = maska > 0
-    maskb = maskb > 0
-    inter_area = sum(sum(np.logical_and(maska, maskb)))
-
-    maska_area = sum(sum(maska))
-    maskb_area = sum(sum(maskb))
+        true_boxes.append(xywh_to_xyxy(truth['bbox'])[0])
+        # mask: the stored crop of the segmentation, the polygons
+        # of the coco file are only the fallback
+        seg_file = os.path.join(
+            seg_path, f'{format_seg_names(data_fr[F_KEY][idx])}.seg.nrrd')
+        if os.path.isfile(seg_file):
+            true_crops.append(get_seg_crop(seg_file).clip(instances.image_size))
+        else:
+            try:
+                true_crops.append(mask_crop(coco.annToMask(truth)))
+            except FileNotFoundError:
+                true_crops.append(empty_crop())
 
-    iou = inter_area / float(maska_area + maskb_area - inter_area)
-    dice = (2 * inter_area) / float(maska_area + maskb_area)
+    # RESULT
+    ious_box, dices_box = box_iou_dice(pred_boxes, true_boxes, pairwise=True)
+    ious_mask, dices_mask = crop_iou_dice(pred_crops, true_crops)
 
-    return iou, dice
+    return list(ious_box), list(dices_box), list(ious_mask), list(dices_mask)
 
 
-def personal_score_simple(predictor, data_fr, active_idx, imgpath="./PNG"):
+def personal_score_simple(predictor, data_fr, active_idx, imgpath="./PNG", batch_size=8):
     """define the accuracy"""
 
     # get the actibe files
@@ -771,27 +1049,27 @@ def personal_score_simple(predictor, data_fr, active_idx, imgpath="./PNG"):
     count = 0
     preds = []
 
-    # Go over the whole dataset
-    for idx in tqdm(active_idx):
-        # load image
-        img = cv2.imread(files[idx])
-
-        with torch.no_grad():
-            outputs = predictor(img)
+    results = predict_files(predictor, [files[idx] for idx in active_idx], batch_size=batch_size)
 
-            # get predicitions
-            out = outputs["instances"].to("cpu")
-            pred = out[:1].pred_classes[0]
+    # Go over the whole dataset
+    for idx, (_, outputs) in tqdm(zip(active_idx, results), total=len(active_idx)):
+        # get predicitions
+        # without a detection the image stays unclassified (None), which is never correct
+        out = outputs["instances"].to("cpu")
+        pred = int(out.pred_classes[0]) if len(out) else None
 
         preds.append(pred)
 
         # select the relevant name from the data_fr
         malignant = data_fr[CLASS_KEY][idx]
 
+        if pred is None:
+            continue
+
         if malignant and pred <= 4:
             count += 1
 
-        if not malignant and (pred >= 4 or None):
+        if not malignant and pred >= 4:
             count += 1
 
     res = count / len(active_idx)
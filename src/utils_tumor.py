@@ -11,8 +11,9 @@
 # general
 import os
 import json
-from datetime import datetime, date
-from itertools import groupby
+import shutil
+import warnings
+from datetime import date
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
@@ -20,14 +21,27 @@ import nrrd
 # open images
 from PIL import Image, ImageFile
 
-# generate polygons:
-from imantics import Mask
-
 # import personal functions
 if __name__ == '__main__':
-    from categories import make_cat_advanced, cat_mapping_new, reverse_cat_list, malign_int
+    from categories import make_cat_advanced, cat_mapping_new, cat_naming_new, reverse_cat_list, \
+        entity_ids, task_labels, is_malign, UNKNOWN_ID
+    from image_index import get_image_index, get_image_info, empty_canvas, file_signature, is_plain_png
+    from seg_store import get_seg_store, get_seg_crop
+    from parallel import map_ordered
+    from prep_manifest import PrepManifest
+    from cohort_stats import calculate_ages, cohort_frame, cohort_tables, print_cohort
+    from polygons import crop_polygons, polygon_iou
+    import rle
 else:
-    from src.categories import make_cat_advanced, cat_mapping_new, reverse_cat_list, malign_int
+    from src.categories import make_cat_advanced, cat_mapping_new, cat_naming_new, reverse_cat_list, \
+        entity_ids, task_labels, is_malign, UNKNOWN_ID
+    from src.image_index import get_image_index, get_image_info, empty_canvas, file_signature, is_plain_png
+    from src.seg_store import get_seg_store, get_seg_crop
+    from src.parallel import map_ordered
+    from src.prep_manifest import PrepManifest
+    from src.cohort_stats import calculate_ages, cohort_frame, cohort_tables, print_cohort
+    from src.polygons import crop_polygons, polygon_iou
+    from src import rle
 
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -45,73 +59,156 @@ CLASS_KEY = 'Aggressiv/Nicht-aggressiv'
 ENTITY_KEY = 'Tumor.Entitaet'
 
 
-def get_advanced_dis_data_fr(data_fr_loc, mode=False):
+SPLIT_NAME = 'splits.json'
+SPLITS = ['train', 'valid', 'test']
+
+_SPLIT_CACHE = {}
+
+
+def get_split_path():
+    """the split manifest lives next to the datainfo in the repository root"""
+    path = os.getcwd()
+    add = "../" if path[-3:] == "src" else ""
+    return os.path.join(path, f'{add}{SPLIT_NAME}')
+
+
+def load_split_manifest(split_path):
+    """case name -> split, cached as long as the file is unchanged"""
+    if not os.path.isfile(split_path):
+        return {}
+    signature = file_signature(split_path)
+    cached = _SPLIT_CACHE.get(split_path)
+    if cached is None or cached[0] != signature:
+        with open(split_path, 'r') as file:
+            cached = (signature, json.load(file))
+        _SPLIT_CACHE[split_path] = cached
+    return cached[1]
+
+
+def save_split_manifest(manifest, split_path):
+    """write the manifest, the cache is refreshed on the next load"""
+    tmp_path = f'{split_path}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, split_path)
+
+
+def compute_splits(data_fr_loc):
     """
-    redefine the dataframe distribution for advanced training -> separate by entities!
+    split per entity in row order: the first part train, then valid, the
+    rest test. rows with unknown entities get no split
     """
-    # 1. get number of entities in overall_data_fr_loc
-    # 2. split entities according to train, val / test-split
+    entity = data_fr_loc[ENTITY_KEY]
+    known = entity.isin(reverse_cat_list)
+    groups = entity[known]
 
-    # init the empyt idx lists
-    train_idx = []
-    valid_idx = []
-    test_idx = []
+    rank = groups.groupby(groups).cumcount().to_numpy()
+    size = groups.map(groups.value_counts()).to_numpy()
 
-    # get the categories by which to split
-    cats = reverse_cat_list
+    validlen = np.round(size * VALID_PART)
+    testlen = np.round(size * TEST_PART)
+    trainlen = size - validlen - testlen
 
-    for cat in cats:
-        # get all matching data_fr_loc entries
-        data_fr_loc_loc = data_fr_loc.loc[data_fr_loc[ENTITY_KEY] == cat]
-        loclen = len(data_fr_loc_loc)
+    split = np.where(rank < trainlen, 'train',
+                     np.where(rank < trainlen + validlen, 'valid', 'test'))
+    return pd.Series(split, index=groups.index).reindex(data_fr_loc.index)
 
-        # now split acc to the indices
-        validlen = round(loclen * VALID_PART)
-        testlen = round(loclen * TEST_PART)
-        trainlen = loclen - validlen - testlen
 
-        # get the matching indices and extend the idx list
-        data_fr_loc_loc_train = data_fr_loc_loc.iloc[:trainlen]
-        train_idx.extend(list(data_fr_loc_loc_train.index))
+def assign_new_splits(data_fr_loc, manifest):
+    """
+    give the cases missing in the manifest a split, without moving the
+    others: each goes to the split its entity is most short of, ties to the
+    first of SPLITS. all entities are filled in one vectorized pass
+    """
+    names = data_fr_loc[F_KEY].to_numpy()
+    codes = pd.Categorical(data_fr_loc[ENTITY_KEY], categories=reverse_cat_list).codes
+    known = codes >= 0
+    new = known & ~pd.Series(names).isin(manifest.keys()).to_numpy()
+    if not new.any():
+        return False
+
+    # cases per entity and split, with the current manifest
+    split_codes = pd.Categorical(pd.Series(names).map(manifest), categories=SPLITS).codes
+    has_split = known & (split_codes >= 0)
+    counts = np.zeros((len(reverse_cat_list), len(SPLITS)), dtype=np.int64)
+    np.add.at(counts, (codes[has_split], split_codes[has_split]), 1)
+
+    total = np.bincount(codes[known], minlength=len(reverse_cat_list))
+    validlen = np.round(total * VALID_PART)
+    testlen = np.round(total * TEST_PART)
+    missing = np.stack([total - validlen - testlen, validlen, testlen], axis=1) - counts
+
+    # the k-th pick of a split lowers its shortage by k -> the greedy order of
+    # the picks is the descending shortage, then the order of SPLITS
+    picks = np.arange(new.sum())
+    shortage = (missing[:, :, None] - picks).reshape(len(reverse_cat_list), -1)
+    split_of = np.broadcast_to(np.arange(len(SPLITS))[:, None], (len(SPLITS), len(picks))).ravel()
+    order = np.lexsort((np.broadcast_to(split_of, shortage.shape), -shortage), axis=-1)
+    greedy = split_of[order]
+
+    new_codes = codes[new]
+    rank = pd.Series(new_codes).groupby(new_codes).cumcount().to_numpy()
+    manifest.update(zip(names[new], np.array(SPLITS)[greedy[new_codes, rank]].tolist()))
+    return True
+
+
+def split_manifest(data_fr_loc, split_path=None):
+    """
+    case name -> split: the stored manifest, new cases added in memory. without
+    a stored manifest the split by position inside every entity
+    """
+    split_path = split_path or get_split_path()
+    manifest = dict(load_split_manifest(split_path))
+    if not manifest:
+        warnings.warn(f'no split manifest at {split_path}, the splits are computed from the row '
+                      'order and move if cases are added. store them with write_split_manifest')
+        splits = compute_splits(data_fr_loc)
+        known = splits.notna()
+        manifest = dict(zip(data_fr_loc[F_KEY][known], splits[known]))
+    else:
+        assign_new_splits(data_fr_loc, manifest)
+    return manifest
 
-        data_fr_loc_loc_valid = data_fr_loc_loc.iloc[trainlen:trainlen+validlen]
-        valid_idx.extend(list(data_fr_loc_loc_valid.index))
 
-        data_fr_loc_loc_test = data_fr_loc_loc.iloc[trainlen+validlen::]
-        test_idx.extend(list(data_fr_loc_loc_test.index))
+def write_split_manifest(data_fr_loc, split_path=None):
+    """store the split of every current case, later cases then do not move them"""
+    split_path = split_path or get_split_path()
+    manifest = split_manifest(data_fr_loc, split_path)
+    save_split_manifest(manifest, split_path)
+    return manifest
 
-    # summarize in dictionary
-    dis = {
-        'train': {
-            'len': len(train_idx),
-            'idx': train_idx,
-        },
-        'valid': {
-            'len': len(valid_idx),
-            'idx': valid_idx,
-        },
-        'test': {
-            'len': len(test_idx),
-            'idx': test_idx,
-        }
-    }
 
+def get_advanced_dis_data_fr(data_fr_loc, mode=False, split_path=None):
+    """
+    redefine the dataframe distribution for advanced training -> separate by entities!
+    the splits come from the manifest (see write_split_manifest), nothing is written here
+    """
     if mode:
-        dis = {
+        return {
             'test_external': {
                 'len': len(data_fr_loc),
                 'idx': list(range(len(data_fr_loc))),
             }
         }
 
-    return dis
-
+    manifest = split_manifest(data_fr_loc, split_path)
+    split = data_fr_loc[F_KEY].map(manifest).to_numpy()
+
+    # order by entity, then by row -> the order of the former split
+    codes = pd.Categorical(data_fr_loc[ENTITY_KEY], categories=reverse_cat_list).codes
+    order = np.lexsort((np.arange(len(codes)), codes))
+    order = order[codes[order] >= 0]
+    index = data_fr_loc.index.to_numpy()
+
+    dis = {}
+    for key in SPLITS:
+        idx = index[order[split[order] == key]].tolist()
+        dis[key] = {
+            'len': len(idx),
+            'idx': idx,
+        }
 
-def calculate_age(born, diag):
-    """get the age from the calendar dates"""
-    born = datetime.strptime(born, "%d.%m.%Y").date()
-    diag = datetime.strptime(diag, "%d.%m.%Y").date()
-    return diag.year - born.year
+    return dis
 
 
 def apply_cat(train, valid, test, dis, new_name, new_cat):
@@ -126,144 +223,114 @@ def apply_cat(train, valid, test, dis, new_name, new_cat):
     return train, valid, test
 
 
-def get_data_fr_dis(data_fr_loc, born_key='OrTBoard_Patient.GBDAT', diag_key='Erstdiagnosedatum',
-                    t_key='Tumor.Entitaet', pos_key='Befundlokalisation', out=True,
-                    mode=False):
+def get_cohort_tables(data_fr_loc, born_key='OrTBoard_Patient.GBDAT', diag_key='Erstdiagnosedatum',
+                      t_key='Tumor.Entitaet', pos_key='Befundlokalisation', mode=False):
     """
-    extract ages and other information from data_fr_loc
+    ages and the cohort tables of all splits (summary, entity, location, sex, malignancy)
     """
-
     # get ages
     if mode:
-        ages_loc = data_fr_loc['Alter bei Erstdiagnose']
+        ages_loc = data_fr_loc['Alter bei Erstdiagnose'].to_numpy()
     else:
-        ages_loc = [calculate_age(born, diag) for (born, diag) in zip(
-            data_fr_loc[born_key], data_fr_loc[diag_key])]
-
-    # get labels
-    labels = [float(lab) for lab in data_fr_loc[CLASS_KEY]]
+        ages_loc = calculate_ages(data_fr_loc[born_key], data_fr_loc[diag_key])
 
-    # get male(0) / female(1)
-    if mode:
-        female_male = [1 if d_loc ==
-                       'f' else 0 for d_loc in data_fr_loc['Geschlecht']]
-    else:
-        female_male = [int(name[0] == 'F') for name in data_fr_loc[F_KEY]]
+    # get the shuffled indexes
+    dis = get_advanced_dis_data_fr(data_fr_loc, mode=mode)
 
-    # tumor_kind
-    tumor_kind = data_fr_loc[t_key]
+    frame = cohort_frame(data_fr_loc, dis, ages_loc, t_key=t_key, pos_key=pos_key,
+                         class_key=CLASS_KEY, f_key=F_KEY, mode=mode)
+    return ages_loc, cohort_tables(frame, dis.keys())
 
-    # position
-    position = data_fr_loc[pos_key]
 
-    # get the shuffled indexes
-    dis = get_advanced_dis_data_fr(data_fr, mode=mode)
+def get_data_fr_dis(data_fr_loc, born_key='OrTBoard_Patient.GBDAT', diag_key='Erstdiagnosedatum',
+                    t_key='Tumor.Entitaet', pos_key='Befundlokalisation', out=True,
+                    mode=False):
+    """
+    extract ages and other information from data_fr_loc
+    """
+    ages_loc, tables = get_cohort_tables(data_fr_loc, born_key=born_key, diag_key=diag_key,
+                                         t_key=t_key, pos_key=pos_key, mode=mode)
 
     if out:
-        for key in dis.keys():
-            print(f"{key}:")
-            print_info(ages_loc, labels, female_male,
-                       dis[key]['idx'], tumor_kind, position)
-
-        print("All:")
-        print_info(ages_loc, labels, female_male, list(
-            range(len(ages_loc))), tumor_kind, position)
+        print_cohort(tables)
 
     return ages_loc
 
 
-def print_info(loc_ages, labels, female_male, active_idx, tumor_kind, position, nums=1):
+# %% Preparation: Create the coco format
+
+
+def read_data_fr(csv_path, mode=False):
     """
-    summarize all informations as a print message
+    read the datainfo csv / external xlsx through a columnar cache next to
+    it (feather, pickle without pyarrow), rebuilt whenever the source changed
     """
+    cache_path = f'{os.path.splitext(csv_path)[0]}.feather'
+    signature_path = f'{cache_path}.json'
+    signature = file_signature(csv_path)
+
+    if os.path.isfile(signature_path):
+        with open(signature_path, 'r') as file:
+            cached = json.load(file)
+        if cached["signature"] == signature and os.path.isfile(cache_path):
+            if cached["format"] == 'feather':
+                return pd.read_feather(cache_path)
+            return pd.read_pickle(cache_path)
 
-    age = np.array([loc_ages[i] for i in active_idx]).mean().round(nums)
-    age_std = np.array([loc_ages[i]
-                        for i in active_idx]).std().round(nums)
-    print(f'Age: {age} ± {age_std}')
+    if mode:
+        data_fr_loc = pd.read_excel(csv_path)
+    else:
+        data_fr_loc = pd.read_csv(csv_path, header='infer', delimiter=';')
 
-    females = np.array([female_male[i] for i in active_idx]).sum()
-    femals_p = round((100*females) / len(active_idx), nums)
-    print(f'Female: {females} ({femals_p}%)')
+    try:
+        data_fr_loc.to_feather(cache_path)
+        cache_format = 'feather'
+    except (ImportError, ValueError, TypeError):
+        # no pyarrow or columns of mixed types
+        data_fr_loc.to_pickle(cache_path)
+        cache_format = 'pickle'
 
-    malign = int(np.array([labels[i] for i in active_idx]).sum())
-    malign_p = round((100 * malign) / len(active_idx), nums)
-    print(f'Malignancy: {malign} ({malign_p}%)')
-    print(f'Benign: {len(active_idx)-malign} ({100-malign_p}%)')
+    with open(signature_path, 'w') as file:
+        json.dump({"signature": signature, "format": cache_format}, file)
 
-    _, cat_mapping = make_cat_advanced(simple=False)
+    return data_fr_loc
 
-    tumor_list = list(cat_mapping.keys())
 
-    for tumor in tumor_list:
-        tums = [int(tumor == name)
-                for name in tumor_kind[active_idx]]
-        num_tums = np.array(tums).sum()
-        per_tum = round(100 * num_tums / len(active_idx), nums)
-        print(f'{tumor}: {num_tums} ({per_tum}%)')
+# task columns of the datainfo: the entity is a column already and the
+# malignancy is CLASS_KEY, so 'All Entities' and 'malignant' are left out
+CSV_TASKS = [loc_cat for loc_cat in cat_naming_new if loc_cat['index'] not in (0, 5)]
 
-    position_dict = {}
-    position_dict['Torso/head'] = ['Becken',
-                                   'Thoraxwand', 'Huefte', 'LWS', 'os sacrum']
-    position_dict['Upper Extremity'] = [
-        'Oberarm', 'Hand', 'Schulter', 'Unterarm']
-    position_dict['Lower Extremity'] = [
-        'Unterschenkel', 'Fuß', 'Knie', 'Oberschenkel']
 
-    for pos_k in position_dict.keys():
-        cur_pos = [int(p in position_dict[pos_k])
-                   for p in position[active_idx]]
-        num_pos = np.array(cur_pos).sum()
-        per_pos = round(100 * num_pos / len(active_idx), nums)
-        print(f'{pos_k}: {num_pos} ({per_pos}%)')
+def get_task_columns(entities):
+    """
+    the CSV_TASKS for a column of entity names, in one lookup
+    """
+    task_names = [loc_cat['name'] for loc_cat in CSV_TASKS]
+    task_index = [loc_cat['index'] for loc_cat in CSV_TASKS]
+    ids = entity_ids(entities)
 
-    dset_part = round(100 * len(active_idx) / len(loc_ages), nums)
-    print(f'Dataset Nums: {len(active_idx)} ({dset_part}%)\n\n')
+    unknown = set(entities[ids == UNKNOWN_ID])
+    if unknown:
+        raise KeyError(f'Unknown entities: {unknown}')
 
-# %% Preparation: Create the coco format
+    labels = task_labels(ids)[:, task_index].astype(float)
+    return pd.DataFrame(labels, index=entities.index, columns=task_names)
 
 
 def add_classes_to_csv(csv_path, mode=False):
     """
-    construct the bounding boxes and add them to the csv file
+    construct the task columns and add them to the csv file
     """
     # open csv
-    if mode:
-        data_fr_loc = pd.read_excel(csv_path)
-    else:
-        data_fr_loc = pd.read_csv(csv_path, header='infer', delimiter=';')
-
-    len_data_fr = len(data_fr_loc)
-
-    # predefine arrays
-    agg_non_agg, ben_loc_mal, clinicla_flow, clinicla_flow_red, super_ent = np.empty(
-        [len_data_fr]), np.empty([len_data_fr]), np.empty([len_data_fr]), np.empty(
-        [len_data_fr]), np.empty([len_data_fr])
-
-    # iterate trough the files:
-    for i, label in tqdm(enumerate(data_fr_loc[ENTITY_KEY])):
-        agg_non_agg[i] = cat_mapping_new[label][1]
-        ben_loc_mal[i] = cat_mapping_new[label][2]
-        clinicla_flow[i] = cat_mapping_new[label][3]
-        clinicla_flow_red[i] = cat_mapping_new[label][4]
-        super_ent[i] = cat_mapping_new[label][6]
+    data_fr_loc = read_data_fr(csv_path, mode=mode)
 
-    benmal_info = []
-    for loc_ent in data_fr_loc[ENTITY_KEY]:
-        ent_int = cat_mapping_new[loc_ent][0]
-        benmal = 1 if ent_int in malign_int else 0
-        benmal_info.append(benmal)
+    entities = data_fr_loc[ENTITY_KEY]
+    tasks = get_task_columns(entities)
 
-    long_txt = 'Grade for clinical workflow (2 + 3 = 2 > assessment in MSK center needed)'
-
-    # add the bounding boxes to the dataframe
-    data_fr_loc[CLASS_KEY] = benmal_info
-    data_fr_loc[long_txt] = clinicla_flow_red
-
-    data_fr_loc['Aggressive - Non Aggressive'] = agg_non_agg
-    data_fr_loc['Benigne - Local Aggressive - Maligne'] = ben_loc_mal
-    data_fr_loc['Grade of clinical workflow'] = clinicla_flow
-    data_fr_loc['Super Entity (chon: 0, osteo:1, meta:2, other:3)'] = super_ent
+    # add the labels to the dataframe
+    data_fr_loc[CLASS_KEY] = is_malign(entity_ids(entities)).astype(int)
+    for task_name in tasks.columns:
+        data_fr_loc[task_name] = tasks[task_name]
 
     # save to csv!
     if mode:
@@ -279,24 +346,20 @@ def nrrd_2_mask(nrrd_path, im_path, nrrd_key='Segmentation_ReferenceImageExtentO
     """
     generate mask from the nrrd file
     """
-    # load nrrd image
-    readdata, header = nrrd.read(nrrd_path)
-    nrrd_img = np.transpose(readdata[:, :, 0] * fac)
+    # the segmentation is decoded once and kept as crop in the folder's store
+    seg_crop = get_seg_crop(nrrd_path, nrrd_key)
 
-    # get the offsets
-    offset = header[nrrd_key].split()
-    offset = [int(off) for off in offset]
-    offset = offset[0:2]
-
-    # load true image
-    background = Image.open(im_path)
-    foreground = Image.fromarray(nrrd_img)
+    # the true image is only needed for its size -> read the png header
+    if as_array:
+        info = get_image_info(im_path)
+        return seg_crop.to_full((info["height"], info["width"]), fac=fac)
 
     # generate masked image
-    mask = Image.fromarray(np.array(background) * 0)
-    mask.paste(foreground, offset, foreground)
+    mask = empty_canvas(im_path)
+    full = seg_crop.to_full(mask.shape, fac=fac)
+    mask[...] = full if mask.ndim == 2 else full[:, :, np.newaxis]
 
-    return np.array(mask)[:, :, 0] if as_array else mask
+    return Image.fromarray(mask)
 
 
 def format_seg_names(name):
@@ -309,33 +372,94 @@ def format_seg_names(name):
     return name
 
 
-def generate_masks(data_frame, nrrd_path, pic_path, mask_path, gen_rad=True):
+def is_up_to_date(outputs, inputs):
+    """all outputs exist and are newer than all inputs"""
+    if not all(os.path.isfile(out) for out in outputs):
+        return False
+    oldest_out = min(os.path.getmtime(out) for out in outputs)
+    return all(os.path.getmtime(inp) <= oldest_out for inp in inputs)
+
+
+def export_mask_job(job):
     """
-    save all pictures in a masked version in the mask_folder
+    pool job: write the mask png and the radiomics label of one case
+    job = (file, nrrd_path, pic_path, mask_path, rad_path, force), rad_path None -> no label.
+    returns (file, status, message, image index entries read by this process)
     """
+    file, status, message = _export_mask(*job)
+    return file, status, message, get_image_index().known_entries(
+        [os.path.join(job[2], f'{file}.png')])
+
+
+def _export_mask(file, nrrd_path, pic_path, mask_path, rad_path, force):
+    """write the mask png and the radiomics label, returns (file, status, message)"""
+    # get names
+    pic_name = os.path.join(pic_path, f'{file}.png')
+    seg_name = format_seg_names(file)
+    nrrd_name = os.path.join(nrrd_path, f'{seg_name}.seg.nrrd')
+    mask_name = os.path.join(mask_path, f'{seg_name}.png')
+    outputs = [mask_name]
+    if rad_path is not None:
+        outputs.append(os.path.join(rad_path, f'{seg_name}.nrrd'))
+
+    if not os.path.isfile(nrrd_name):
+        return file, 'missing', nrrd_name
+    if not force and is_up_to_date(outputs, [nrrd_name, pic_name]):
+        return file, 'skipped', ''
+
+    # report failing cases instead of stopping the whole export
+    try:
+        # mask the picture
+        mask = nrrd_2_mask(nrrd_name, pic_name, fac=255)
+        mask.save(mask_name)
 
-    for file in tqdm(data_frame[F_KEY]):
-        # get names
-        pic_name = os.path.join(pic_path, f'{file}.png')
-        file = format_seg_names(file)
-        nrrd_name = os.path.join(nrrd_path, f'{file}.seg.nrrd')
+        if rad_path is not None:
+            # radiomics label indexed (x, y, z) like the segmentation, label value 1
+            info = get_image_info(pic_name)
+            label = get_seg_crop(nrrd_name).to_full((info["height"], info["width"])) > 0
+            nrrd.write(outputs[1], label.astype(np.uint8).T[:, :, np.newaxis])
 
-        # mask the picture
-        try:
-            mask = nrrd_2_mask(nrrd_name, pic_name, fac=255)
+    except Exception as err:
+        return file, 'failed', repr(err)
 
-            # save masked picture:
-            mask_name = os.path.join(mask_path, f'{file}.png')
-            mask.save(mask_name)
+    return file, 'written', ''
 
-            if gen_rad:
-                mask = np.array(mask)
-                shape = mask.shape
-                mask = mask.reshape((shape[2], shape[1], shape[0]))
-                nrrd.write(f'../radiomics/label/{file}.nrrd', mask)
 
-        except FileNotFoundError:
-            print(nrrd_name)
+def generate_masks(data_frame, nrrd_path, pic_path, mask_path, gen_rad=True,
+                   rad_path='../radiomics/label', workers=1, force=False):
+    """
+    save all pictures in a masked version in the mask_folder, with
+    gen_rad also the radiomics labels. masks newer than their png and
+    segmentation are skipped unless force is set.
+    returns the report {'written': [...], 'skipped': [...], 'missing': [...], 'failed': {...}}
+    """
+    os.makedirs(mask_path, exist_ok=True)
+    if gen_rad:
+        os.makedirs(rad_path, exist_ok=True)
+
+    files = list(data_frame[F_KEY])
+    jobs = [(file, nrrd_path, pic_path, mask_path, rad_path if gen_rad else None, force)
+            for file in files]
+
+    # decode all segmentations once, the workers then read the saved store
+    get_seg_store(nrrd_path).update(
+        [format_seg_names(file) + '.seg.nrrd' for file in files], workers=workers)
+
+    report = {'written': [], 'skipped': [], 'missing': [], 'failed': {}}
+    index = get_image_index()
+    for file, status, message, entries in tqdm(map_ordered(export_mask_job, jobs, workers=workers),
+                                               total=len(jobs)):
+        if status == 'failed':
+            report['failed'][file] = message
+        else:
+            report[status].append(file)
+        # the workers read the image sizes into their own index copies
+        index.merge(entries)
+
+    # keep the image sizes read on the way
+    index.save()
+
+    return report
 
 # %% coco-formatting
 
@@ -367,9 +491,12 @@ def make_empty_coco(mode='train', simple=True):
     return coco, cat_mapping
 
 
-def get_cocos_from_data_fr(data_fr_loc, paths_loc, save=True, simple=True, newmode=0, ex_mode=False):
+def get_cocos_from_data_fr(data_fr_loc, paths_loc, save=True, simple=True, newmode=0, ex_mode=False,
+                           workers=1, manifest=None, tolerance=0.0):
     """
-    build the coco dictionaries from the dataframe
+    build the coco dictionaries from the dataframe,
+    pass a PrepManifest to only recompute changed cases,
+    tolerance > 0 simplifies the polygons (max. deviation in pixels)
     """
     # get the shuffled indexes
     dis = get_advanced_dis_data_fr(data_fr_loc, mode=ex_mode)
@@ -383,7 +510,8 @@ def get_cocos_from_data_fr(data_fr_loc, paths_loc, save=True, simple=True, newmo
 
         # make empty coco_dict
         cocos_loc.append(make_coco(data_fr_loc, mode, indices, newmode=newmode,
-                                   simple=simple, path=paths_loc["pic"], path_nrd=paths_loc["seg"]))
+                                   simple=simple, path=paths_loc["pic"], path_nrd=paths_loc["seg"],
+                                   workers=workers, manifest=manifest, tolerance=tolerance))
 
         if save:
             local_path = os.getcwd()
@@ -439,32 +567,114 @@ def check_seg(segl):
     return checked
 
 
-def make_coco(data_frame, mode, idxs, path='../PNG2', path_nrd='../SEG', simple=True, newmode=0):
+def make_coco_entry(job):
+    """
+    get the image size and the annotation geometry of a single case
+    job = (file, path, path_nrd, tolerance), top level to be usable in a process pool
+    """
+    file, path, path_nrd, tolerance = job
+
+    # get height and width from the png header
+    filepath = os.path.join(path, file + '.png')
+    info = get_image_info(filepath)
+    height, width = info["height"], info["width"]
+
+    # get the segmentation
+    segname = format_seg_names(file)
+
+    # contours of the crop only, the full size mask is never built
+    nrrdpath = os.path.join(path_nrd, segname + '.seg.nrrd')
+    seg_crop = get_seg_crop(nrrdpath).clip((height, width))
+    segm = check_seg(crop_polygons(seg_crop, tolerance=tolerance))
+
+    return {
+        "height": height,
+        "width": width,
+        "area": seg_crop.area,
+        "segmentation": segm,
+        "bbox": bbox_from_segm(segm),
+        "tolerance": tolerance,
+        "polygon_iou": polygon_iou(segm, seg_crop),
+    }
+
+
+def collect_coco_entries(jobs, rows, workers=1, manifest=None):
+    """
+    image / annotation geometry of all jobs, in order. with a manifest only
+    cases whose row, png or segmentation changed are computed again
+    """
+    png_paths = [os.path.join(path, file + '.png') for file, path, _, _ in jobs]
+    seg_paths = [os.path.join(path_nrd, format_seg_names(file) + '.seg.nrrd')
+                 for file, _, path_nrd, _ in jobs]
+
+    entries = [None] * len(jobs)
+    hashes = [None] * len(jobs)
+    if manifest is not None:
+        for i, (png_path, seg_path, row) in enumerate(zip(png_paths, seg_paths, rows)):
+            hashes[i] = manifest.hashes(png_path, seg_path, row)
+            entries[i] = manifest.lookup(png_path, hashes[i])
+            # polygons of another tolerance are computed again
+            if entries[i] is not None and entries[i].get("tolerance", 0.0) != jobs[i][3]:
+                entries[i] = None
+
+    todo = [i for i, entry in enumerate(entries) if entry is None]
+    if manifest is not None:
+        print(f'Reusing {len(jobs) - len(todo)} of {len(jobs)} cases')
+
+    # index all image headers and segmentations once, the workers then
+    # read the saved index and store
+    index = get_image_index()
+    for i in todo:
+        index.get(png_paths[i])
+    index.save()
+    for path_nrd in set(jobs[i][2] for i in todo):
+        get_seg_store(path_nrd).update(
+            [os.path.basename(seg_paths[i]) for i in todo if jobs[i][2] == path_nrd],
+            workers=workers)
+
+    new_entries = map_ordered(make_coco_entry, [jobs[i] for i in todo], workers=workers)
+    for i, entry in tqdm(zip(todo, new_entries), total=len(todo)):
+        entries[i] = entry
+        # every finished case is written at once -> an interrupted run resumes here
+        if manifest is not None:
+            manifest.add(png_paths[i], hashes[i], entry)
+
+    if manifest is not None and todo:
+        manifest.compact()
+
+    # accuracy of the polygons against the raster masks
+    ious = [entry["polygon_iou"] for entry in entries if "polygon_iou" in entry]
+    if ious:
+        print(f'Polygon IoU: mean {np.mean(ious):.4f}, min {np.min(ious):.4f}')
+
+    return entries
+
+
+def make_coco(data_frame, mode, idxs, path='../PNG2', path_nrd='../SEG', simple=True, newmode=0,
+              workers=1, manifest=None, tolerance=0.0):
     """fill the coco with the annotations"""
 
     # create the empty coco format
     coco, cat_mapping = make_empty_coco(mode, simple=simple)
 
-    # go trough all indexes and append the img-names and annotations
-    for idx in idxs:
-
-        # get the current object
-        obj = data_frame.iloc[idx]
+    # pull the relevant columns once instead of per row
+    files = data_frame[F_KEY].to_numpy()
+    names = data_frame[CLASS_KEY if simple else ENTITY_KEY].to_numpy()
+    row_keys = [key for key in [F_KEY, CLASS_KEY, ENTITY_KEY] if key in data_frame]
+    rows = data_frame[row_keys].to_numpy()
 
-        # get the filename
-        file = obj[F_KEY]
-        filename = file + '.png'
+    jobs = [(files[idx], path, path_nrd, tolerance) for idx in idxs]
+    entries = collect_coco_entries(
+        jobs, [rows[idx] for idx in idxs], workers=workers, manifest=manifest)
 
-        # get height and width by loading the picture
-        filepath = os.path.join(path, filename)
-        img_s = np.array(Image.open(filepath)).shape
-        height, width = img_s[0], img_s[1]
+    # go trough all indexes and append the img-names and annotations
+    for idx, entry in zip(idxs, entries):
 
         # get the image id -> idx should be unique
         id_tumor = int(idx)
 
         # get the class:
-        name = obj[CLASS_KEY] if simple else obj[ENTITY_KEY]
+        name = names[idx]
 
         cat = cat_mapping[name]
 
@@ -474,9 +684,9 @@ def make_coco(data_frame, mode, idxs, path='../PNG2', path_nrd='../SEG', simple=
         # build the image dictionary
         img_dict = {
             "id": id_tumor,
-            "file_name": filename,
-            "height": height,
-            "width": width,
+            "file_name": files[idx] + '.png',
+            "height": entry["height"],
+            "width": entry["width"],
         }
 
         # build the annotation dictionary
@@ -485,22 +695,11 @@ def make_coco(data_frame, mode, idxs, path='../PNG2', path_nrd='../SEG', simple=
             "image_id": id_tumor,
             "category_id": cat,
             "iscrowd": 0,
-            "area": int(height * width),
+            "area": entry["area"],
+            "segmentation": entry["segmentation"],
+            "bbox": entry["bbox"],
         }
 
-        # get the segmentation
-        segname = format_seg_names(file)
-
-        # get the rle - mask
-        nrrdpath = os.path.join(path_nrd, segname + '.seg.nrrd')
-        mask = nrrd_2_mask(nrrdpath, filepath, as_array=True)
-        polygons = Mask(mask).polygons()
-
-        ann_dict["area"] = int(np.sum(mask > 0))
-        segm = check_seg(polygons.segmentation)
-        ann_dict["segmentation"] = segm
-        ann_dict['bbox'] = bbox_from_segm(segm)
-
         # append the dictionaries to the coco bunch
         coco['images'].append(img_dict)
         coco['annotations'].append(ann_dict)
@@ -508,17 +707,13 @@ def make_coco(data_frame, mode, idxs, path='../PNG2', path_nrd='../SEG', simple=
     return coco
 
 
-def binary_mask_to_rle(binary_mask):
+def binary_mask_to_rle(binary_mask, offset=(0, 0), size=None, compressed=False):
     """
-    https://stackoverflow.com/questions/49494337/encode-numpy-array-using-uncompressed-rle-for-coco-dataset
+    uncompressed coco rle of the mask, from the run boundaries in numpy.
+    binary_mask can be a crop at offset (x, y) of an image of size (height, width),
+    compressed gives the string counts of pycocotools
     """
-    rle = {'counts': [], 'size': list(binary_mask.shape)}
-    counts = rle.get('counts')
-    for i, (value, elements) in enumerate(groupby(binary_mask.ravel(order='F'))):
-        if i == 0 and value == 1:
-            counts.append(0)
-        counts.append(len(list(elements)))
-    return rle
+    return rle.encode(binary_mask, offset=offset, size=size, compressed=compressed)
 
 
 def get_data_fr_paths(mode=False):
@@ -552,36 +747,67 @@ def get_data_fr_paths(mode=False):
     }
 
     # get data_fr
-    if mode:
-        data_frame = pd.read_excel(paths_loc["csv"])
-    else:
-        data_frame = pd.read_csv(
-            paths_loc["csv"], header='infer', delimiter=';')
+    data_frame = read_data_fr(paths_loc["csv"], mode=mode)
 
     return data_frame, paths_loc
 
 
-def regenerate_ex_names(paths_loc, new_path='../PNG_external'):
+def copy_image_job(job):
+    """
+    pool job: put the image under its new name.
+    method 'link' / 'copy' keep the bytes, 'encode' writes it again with PIL,
+    'auto' only encodes pngs carrying metadata chunks
+    """
+    src, dst, method = job
+
+    if method == 'auto':
+        method = 'link' if is_plain_png(src) else 'encode'
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    if method == 'link':
+        try:
+            os.link(src, dst)
+            return method
+        except OSError:
+            # other filesystem or no hardlinks supported
+            method = 'copy'
+
+    if method == 'copy':
+        shutil.copyfile(src, dst)
+    else:
+        Image.open(src).save(dst)
+
+    return method
+
+
+def regenerate_ex_names(paths_loc, new_path='../PNG_external', method='auto', workers=1):
     """redefine the external path names"""
     # append idlist
-    data_fr_external = pd.read_excel(paths_loc["csv"])
+    data_fr_external = read_data_fr(paths_loc["csv"], mode=True)
     idlist = np.array(list(range(1, len(data_fr_external)+1)))
     np.random.shuffle(idlist)
     data_fr_external['id'] = idlist
+
+    # write the id mapping once
     data_fr_external.to_excel(paths_loc["csv"])
 
-    data_fr_external = pd.read_excel(paths_loc["csv"])
+    os.makedirs(new_path, exist_ok=True)
     old_path = paths_loc['pic']
-    for num, fname in zip(data_fr_external['id'], data_fr_external[F_KEY]):
-        filename = f'{old_path}/{fname}.png'
-        img = Image.open(filename)
-        filename_new = f'{new_path}/{num}.png'
-        img.save(filename_new)
+    jobs = [(f'{old_path}/{fname}.png', f'{new_path}/{num}.png', method)
+            for num, fname in zip(data_fr_external['id'], data_fr_external[F_KEY])]
+
+    methods = list(tqdm(map_ordered(copy_image_job, jobs, workers=workers), total=len(jobs)))
+    print(', '.join(f'{name}: {methods.count(name)}' for name in sorted(set(methods))))
+
+    return data_fr_external
 
 
 # %% Perform dataset preparation
 if __name__ == '__main__':
     SIMPLE = True
+    WORKERS = os.cpu_count()
+    MANIFEST = PrepManifest()
 
     for external_mode in [False, True]:
         # get the paths
@@ -595,10 +821,15 @@ if __name__ == '__main__':
         print('\n\nAdd the detailed classes to the csv')
         add_classes_to_csv(paths["csv"], mode=external_mode)
 
+        # %% fix the splits before the first coco export, later cases do not move them
+        if not external_mode:
+            write_split_manifest(data_fr)
+
         # %% build the coco-formated json
         print('\n\nTransform to coco format')
         cocos = get_cocos_from_data_fr(
-            data_fr, paths, save=True, simple=SIMPLE, newmode=0, ex_mode=external_mode)
+            data_fr, paths, save=True, simple=SIMPLE, newmode=0, ex_mode=external_mode,
+            workers=WORKERS, manifest=MANIFEST)
 
 
 # %%
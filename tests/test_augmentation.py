@@ -0,0 +1,85 @@
+# %%
+#
+#  test_augmentation.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-26.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# the fused training augmentation against the sequential detectron2 stack
+import numpy as np
+import cv2
+import pytest
+
+pytest.importorskip("detectron2")
+pytest.importorskip("torchvision")
+
+from detectron2.data import transforms as T  # noqa: E402
+from src.utils_detectron import (  # noqa: E402
+    FusedAffineTransform, FusedPhotometricTransform, RotTransform, LUMA)
+
+
+CROP = (30, 20, 240, 330)
+OUT_SIZE = (440, 320)
+DEGREE = 30
+LIGHT = np.array([4.0, -2.0, 1.5])
+BRIGHT, CONTRAST, SATUR = 1.08, 0.92, 1.2
+
+
+def radiograph(height=400, width=300):
+    """smooth gray image with three equal channels, no pixel is 0"""
+    y_grid, x_grid = np.mgrid[0:height, 0:width]
+    gray = 130 + 60 * np.sin(x_grid / 37.0) * np.cos(y_grid / 53.0) + 0.1 * (x_grid - y_grid)
+    gray = np.clip(gray, 20, 235).astype(np.uint8)
+    return np.repeat(gray[:, :, None], 3, axis=2)
+
+
+def sequential(img, hflip, vflip):
+    """the baseline order: crop, resize, flips, photometric blends, rotation"""
+    x_0, y_0, c_w, c_h = CROP
+    out_h, out_w = OUT_SIZE
+    img = T.CropTransform(x_0, y_0, c_w, c_h).apply_image(img)
+    img = T.ResizeTransform(c_h, c_w, out_h, out_w).apply_image(img)
+    if hflip:
+        img = T.HFlipTransform(out_w).apply_image(img)
+    if vflip:
+        img = T.VFlipTransform(out_h).apply_image(img)
+    img = T.BlendTransform(src_image=LIGHT, src_weight=1.0, dst_weight=1.0).apply_image(img)
+    img = T.BlendTransform(src_image=0, src_weight=1 - BRIGHT, dst_weight=BRIGHT).apply_image(img)
+    img = T.BlendTransform(
+        src_image=img.mean(), src_weight=1 - CONTRAST, dst_weight=CONTRAST).apply_image(img)
+    img = T.BlendTransform(
+        src_image=img.dot(LUMA)[:, :, np.newaxis], src_weight=1 - SATUR, dst_weight=SATUR
+    ).apply_image(img)
+    return RotTransform(DEGREE, out_h, out_w).apply_image(img)
+
+
+def fused(img, hflip, vflip):
+    """the training pipeline: the photometric pass, then the single warp"""
+    photo = FusedPhotometricTransform(LIGHT, BRIGHT, CONTRAST, SATUR, region=CROP)
+    warp = FusedAffineTransform(CROP, OUT_SIZE, hflip, vflip, DEGREE)
+    return warp.apply_image(photo.apply_image(img))
+
+
+@pytest.mark.parametrize("hflip, vflip", [(False, False), (True, False), (True, True)])
+def test_fused_matches_sequential_with_rotation_border(hflip, vflip):
+    img = radiograph()
+    expected = sequential(img, hflip, vflip)
+    result = fused(img, hflip, vflip)
+    assert result.shape == expected.shape
+
+    # the rotation border: black in both, the blends must not brighten it
+    out_h, out_w = OUT_SIZE
+    inside = RotTransform(DEGREE, out_h, out_w).apply_image(
+        np.full((out_h, out_w), 255, dtype=np.uint8)) > 0
+    kernel = np.ones((5, 5), dtype=np.uint8)
+    border = cv2.erode((~inside).astype(np.uint8), kernel).astype(bool)
+    interior = cv2.erode(inside.astype(np.uint8), kernel).astype(bool)
+    assert border.any()
+    assert np.all(result[border] == 0)
+
+    # inside: only the interpolation (bilinear vs. nearest rotation) differs
+    diff = result[interior].astype(np.float64) - expected[interior]
+    assert np.abs(diff).mean() < 2.0
+    assert abs(diff.mean()) < 0.5
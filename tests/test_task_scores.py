@@ -0,0 +1,55 @@
+# %%
+#
+#  test_task_scores.py
+#  BonetumorNet
+#
+#  Created by Nikolas Wilhelm on 2021-07-26.
+#  Copyright © 2021 Nikolas Wilhelm. All rights reserved.
+#
+
+# images without any detection are unclassified: wrong, not in the confusion matrices or the AUROC
+import numpy as np
+
+from src.categories import reverse_cat_list, UNKNOWN_ID
+from src.task_scores import instance_probabilities, predicted_ids, multi_task_scores
+from src.bootstrap import boot_auroc
+
+
+class NoDetections():
+    """the parts of detectron2 Instances read by instance_probabilities, without instances"""
+
+    def __len__(self):
+        return 0
+
+    def has(self, name):
+        return False
+
+
+def test_no_detection_is_unclassified():
+    probs = instance_probabilities(NoDetections())
+    assert probs.shape == (len(reverse_cat_list),)
+    assert np.isnan(probs).all()
+    assert predicted_ids(probs[None])[0] == UNKNOWN_ID
+
+
+def test_multi_task_scores_without_detection():
+    num = len(reverse_cat_list)
+    # two correct images (entity 0 and 5) and one image of entity 0 without detection
+    entity_probs = np.array([np.eye(num)[0], np.eye(num)[5], np.full(num, np.nan)])
+    pred_ids = predicted_ids(entity_probs)
+    true_ids = np.array([0, 5, 0])
+
+    res = multi_task_scores(pred_ids, true_ids, entity_probs)
+    for task_res in res.values():
+        assert np.isclose(task_res['acc'], 2 / 3)
+        assert task_res['conf'].sum() == 2
+
+    # benign / malign: one malign and one benign detected, AUROC over both only
+    assert res['malignant']['auroc'] == 1.0
+
+
+def test_boot_auroc_leaves_out_unclassified():
+    targets = np.array([1, 0, 1, 0])
+    scores = np.array([0.9, 0.1, np.nan, 0.8])
+    auroc = boot_auroc(targets, scores, np.arange(4)[None])
+    assert np.isclose(auroc[0], 1.0)